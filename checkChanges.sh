@@ -1,16 +1,14 @@
 #!/bin/bash
 
-# exit with error status if `make parse-ot2` has work to do
-# NOTE: this doesn't work b/c make uses timestamps and git does not preserve them.
-# if ! make parse-ot2 --question; then
-#     echo '***** MISSING UPDATES TO PROTOBUILDS (.py protocol files): *****';
-#     make parse-ot2 --dry-run;
-#     exit 1;
-# fi
+# NOTE: make uses timestamps, which git does not preserve, so stale OT2
+# builds are found by the content-hash keys next to each build JSON
+# (`make check-ot2`). That check is left out of CI until protoBuilds has
+# been regenerated with `make parse-ot2` and its `.key` files committed;
+# until then it would report every protocol as stale.
 
 # exit with error status if errors/readmes have uncommited updates
 echo 'parsing errors & readmes...'
-make parse-errors parse-README;
+make parse-protocols;
 if [[ $(git ls-files --modified protoBuilds) ]]; then
     echo '***** MISSING UPDATES TO PROTOBUILDS (metadata/readme files): *****';
     git ls-files --modified protoBuilds;
@@ -0,0 +1,330 @@
+"""
+Reorder cherrypicking transfers to cut gantry travel and tip changes.
+
+    plan = plan_transfers(
+        transfer_info, source=lambda row: source_well(row),
+        dest=lambda row: dest_well(row), share_tips=True)
+    ctx.comment(plan.report())
+    for row, new_tip in plan:
+        if new_tip:
+            if pip.has_tip:
+                pip.drop_tip()
+            pip.pick_up_tip()
+        pip.transfer(float(row[7]), source_well(row), dest_well(row),
+                     new_tip='never')
+    pip.drop_tip()
+
+Sources and destinations may be wells, locations or (x, y) positions, and
+are told apart by their position. With `share_tips`, consecutive
+transfers from the same source keep their tip (dispense above the liquid
+for that). Without it every transfer needs a new tip, and what the order
+can save is the way from each tip to its source: pass `tips_at` the tips
+in the order the pipette picks them up, eg
+`[tip for rack in tipracks for tip in rack.wells()]`, so that sources get
+the tips next to them. A single `tips_at` position (by default the trash)
+leaves nothing to save without shared tips, and the file order is kept.
+
+The order is built nearest neighbour first and then improved with 2-opt
+moves over windows of `window` transfers. Transfers that touch the same
+well keep their order: a destination written twice, a source that is the
+destination of an earlier transfer, or a destination that an earlier
+transfer reads from.
+
+`report()` compares the planned order with the file order: travel, tips
+and the seconds they take, with the same speeds and tip handling times
+as the library's run-time estimates.
+
+With a multichannel pipette mounted, `promote_columns` first finds the
+rows that one multichannel transfer can do at once:
+
+    for step_rows, channels in promote_columns(
+            transfer_info, source=source_well, dest=dest_well,
+            volume=lambda row: row[7]):
+        pip = m300 if channels > 1 else p300
+        pip.transfer(float(step_rows[0][7]), source_well(step_rows[0]),
+                     dest_well(step_rows[0]))
+
+Those are sets of 8 rows with the same volume whose sources and
+destinations go down a column, 9 mm apart like the channels: a whole
+column of a 96 well plate, or every other well of a 384 well column. The
+first row of a set is the well the multichannel is aimed at. Rows that
+share a well with rows outside their set stay on the single channel, so
+transfers to the same well keep their order.
+"""
+import math
+
+# mm/s and seconds, as in protolib/parse/timing.py
+XY_SPEED = 400.0
+MOVE_OVERHEAD = 0.2
+TIP_SECONDS = 2.0 + 2.5
+SLOT_SIZE = (132.5, 90.5)
+TRASH_SLOT = 12
+WINDOW = 20
+MAX_PASSES = 3
+# mm between the channels of a multichannel, as in liquids.py
+CHANNEL_SPACING = 9.0
+# how far from CHANNEL_SPACING wells under a multichannel may be, in mm
+SPACING_TOLERANCE = 0.5
+
+
+def slot_center(slot):
+    column, row = (slot - 1) % 3, (slot - 1) // 3
+    return ((column + 0.5) * SLOT_SIZE[0], (row + 0.5) * SLOT_SIZE[1])
+
+
+def position(target):
+    """
+    Returns the (x, y) deck position of a well, location or position.
+    """
+    if hasattr(target, 'top'):
+        target = target.top()
+    if hasattr(target, 'point'):
+        target = target.point
+    return (float(target[0]), float(target[1]))
+
+
+def distance(a, b):
+    return math.hypot(a[0] - b[0], a[1] - b[1])
+
+
+def dependencies(sources, dests):
+    """
+    Returns the transfers each transfer must come after.
+    """
+    after = [set() for _ in sources]
+    last_write = {}
+    reads = {}
+    for i, (source, dest) in enumerate(zip(sources, dests)):
+        if source in last_write:
+            after[i].add(last_write[source])
+        if dest in last_write:
+            after[i].add(last_write[dest])
+        after[i].update(reads.get(dest, ()))
+        reads.setdefault(source, set()).add(i)
+        last_write[dest] = i
+        reads[dest] = set()
+    for i in range(len(after)):
+        after[i].discard(i)
+    return after
+
+
+class TransferPlan(object):
+    def __init__(self, rows, order, new_tips, before, after):
+        self.rows = [rows[i] for i in order]
+        self.order = order
+        self.new_tips = new_tips
+        self.before = before
+        self.after = after
+
+    def __iter__(self):
+        return iter(zip(self.rows, self.new_tips))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def report(self):
+        return ('Transfer order: {:.1f} m of travel, {} tips, {:.0f} s, was '
+                '{:.1f} m, {} tips, {:.0f} s in file order'.format(
+                    self.after['travel_mm'] / 1000, self.after['tips'],
+                    self.after['seconds'],
+                    self.before['travel_mm'] / 1000, self.before['tips'],
+                    self.before['seconds']))
+
+
+class _Planner(object):
+    def __init__(self, sources, dests, share_tips, tips_at, trash_at):
+        self.keys = [
+            (position(source), position(dest))
+            for source, dest in zip(sources, dests)]
+        self.share_tips = share_tips
+        # the positions of the tips, in the order they are picked up
+        self.tips_at = tips_at
+        self.trash_at = trash_at
+        # source to destination, the same in any order
+        self.fixed = [distance(s, d) for s, d in self.keys]
+
+    def shares_tip(self, previous, i):
+        return (self.share_tips and previous is not None and
+                self.keys[previous][0] == self.keys[i][0])
+
+    def leg(self, previous, i, tips=0):
+        """
+        Returns the travel from the end of transfer :param:previous to the
+        start of transfer :param:i, through a tip change unless they share
+        a tip. :param:tips is the number of tips picked up before.
+        """
+        if self.shares_tip(previous, i):
+            return distance(self.keys[previous][1], self.keys[i][0])
+        tip_at = self.tips_at[tips % len(self.tips_at)]
+        travel = distance(self.trash_at, tip_at)
+        if previous is not None:
+            travel += distance(self.keys[previous][1], self.trash_at)
+        return travel + distance(tip_at, self.keys[i][0])
+
+    def new_tips(self, order, start=0, end=None):
+        end = len(order) if end is None else end
+        previous = order[start - 1] if start > 0 else None
+        count = 0
+        for i in order[start:end]:
+            count += not self.shares_tip(previous, i)
+            previous = i
+        return count
+
+    def cost(self, order, start=0, end=None, tips=None):
+        """
+        Returns the travel of transfers :param:start to :param:end of
+        :param:order, after :param:tips tips (by default counted).
+        """
+        end = len(order) if end is None else end
+        if tips is None:
+            tips = self.new_tips(order, 0, start)
+        previous = order[start - 1] if start > 0 else None
+        total = 0.0
+        for i in order[start:end]:
+            total += self.leg(previous, i, tips)
+            tips += not self.shares_tip(previous, i)
+            previous = i
+        return total
+
+    def summary(self, order):
+        new_tips = [
+            not self.shares_tip(previous, i)
+            for previous, i in zip([None] + order[:-1], order)]
+        travel = self.cost(order) + sum(self.fixed)
+        if order:
+            travel += distance(self.keys[order[-1]][1], self.trash_at)
+        moves = 2 * len(order) + 3 * sum(new_tips)
+        return new_tips, {
+            'travel_mm': round(travel, 1),
+            'tips': sum(new_tips),
+            'seconds': round(
+                travel / XY_SPEED + moves * MOVE_OVERHEAD +
+                sum(new_tips) * TIP_SECONDS, 1)}
+
+    def nearest_neighbour(self, after):
+        waiting = [len(before) for before in after]
+        followers = [[] for _ in after]
+        for i, before in enumerate(after):
+            for j in before:
+                followers[j].append(i)
+        ready = {i for i, count in enumerate(waiting) if not count}
+        order = []
+        previous = None
+        tips = 0
+        while ready:
+            i = min(ready, key=lambda i: (self.leg(previous, i, tips), i))
+            ready.remove(i)
+            order.append(i)
+            tips += not self.shares_tip(previous, i)
+            previous = i
+            for j in followers[i]:
+                waiting[j] -= 1
+                if not waiting[j]:
+                    ready.add(j)
+        return order
+
+    def two_opt(self, order, after, window=WINDOW, max_passes=MAX_PASSES):
+        for _ in range(max_passes):
+            improved = False
+            for i in range(len(order) - 1):
+                tips = self.new_tips(order, 0, i)
+                for j in range(i + 1, min(len(order), i + window)):
+                    segment = order[i:j + 1]
+                    inside = set(segment)
+                    if any(after[k] & inside for k in segment):
+                        break  # longer segments would break it as well
+                    end = min(len(order), j + 2)
+                    candidate = order[:i] + segment[::-1] + order[j + 1:]
+                    # a segment that uses another number of tips moves
+                    # every later transfer to another tip
+                    if self.new_tips(candidate, i, end) != \
+                            self.new_tips(order, i, end):
+                        end = len(order)
+                    if self.cost(candidate, i, end, tips) < \
+                            self.cost(order, i, end, tips) - 1e-6:
+                        order = candidate
+                        improved = True
+            if not improved:
+                break
+        return order
+
+
+def plan_transfers(rows, source=lambda row: row[0], dest=lambda row: row[1],
+                   share_tips=False, tips_at=None, trash_at=None,
+                   window=WINDOW):
+    """
+    Returns a `TransferPlan` of :param:rows, in the order that needs the
+    least travel and tips, or in file order if no order needs less.
+    :param:source and :param:dest get the source and destination of a row.
+    :param:tips_at is where the tips are, a position or a list of them in
+    pickup order, and :param:trash_at where the trash is, by default both
+    the trash slot.
+    """
+    trash_at = position(trash_at) if trash_at else slot_center(TRASH_SLOT)
+    if isinstance(tips_at, list) and tips_at:
+        tips_at = [position(tip) for tip in tips_at]
+    else:
+        tips_at = [position(tips_at) if tips_at else trash_at]
+    planner = _Planner([source(row) for row in rows],
+                       [dest(row) for row in rows],
+                       share_tips, tips_at, trash_at)
+    after = dependencies(*zip(*planner.keys)) if rows else []
+    order = planner.two_opt(planner.nearest_neighbour(after), after, window)
+    file_order = list(range(len(rows)))
+    if planner.summary(order)[1]['seconds'] >= \
+            planner.summary(file_order)[1]['seconds']:
+        order = file_order
+    new_tips, planned = planner.summary(order)
+    return TransferPlan(
+        rows, order, new_tips, planner.summary(file_order)[1], planned)
+
+
+def promote_columns(rows, source=lambda row: row[0], dest=lambda row: row[1],
+                    volume=lambda row: row[2], channels=8):
+    """
+    Returns the steps that do :param:rows, as (rows, channels) pairs in
+    file order: sets of :param:channels rows for a multichannel pipette,
+    and single rows.
+    """
+    keys = [(position(source(row)), position(dest(row))) for row in rows]
+    related = dependencies(*zip(*keys)) if rows else []
+    for i, before in enumerate(list(related)):
+        for j in before:
+            related[j].add(i)
+
+    # rows a multichannel can do together have the same volume, source
+    # and destination columns, and distance between source and destination,
+    # and their sources are a multiple of CHANNEL_SPACING apart: the two
+    # interleaved sets of a 384 well column are told apart by their y
+    # modulo CHANNEL_SPACING
+    candidates = {}
+    for i, (source_at, dest_at) in enumerate(keys):
+        candidates.setdefault((
+            round(source_at[0], 1), round(dest_at[0], 1),
+            round(source_at[1] - dest_at[1], 1),
+            round(source_at[1] % CHANNEL_SPACING, 1) % CHANNEL_SPACING,
+            float(volume(rows[i]))), []).append(i)
+
+    promoted = {}
+    for members in candidates.values():
+        if len(members) < channels:
+            continue
+        run = []
+        for i in sorted(members, key=lambda i: -keys[i][0][1]):
+            if run and abs(keys[run[-1]][0][1] - keys[i][0][1] -
+                           CHANNEL_SPACING) > SPACING_TOLERANCE:
+                run = []
+            run.append(i)
+            if len(run) == channels:
+                if all(related[j] <= set(run) for j in run):
+                    promoted[min(run)] = run
+                run = []
+
+    in_sets = {i for run in promoted.values() for i in run}
+    steps = []
+    for i, row in enumerate(rows):
+        if i in promoted:
+            steps.append(([rows[j] for j in promoted[i]], channels))
+        elif i not in in_sets:
+            steps.append(([row], 1))
+    return steps
@@ -0,0 +1,192 @@
+"""
+Liquid heights of every well of a labware, from its definition.
+
+    tracker = LiquidTracker(plate, volumes=200)
+    m300.aspirate(50, tracker.aspirate(plate.rows()[0][0], 50, channels=8))
+
+    for location in tracker.aspirate(plate.rows()[0][:6], 50, channels=8):
+        m300.pick_up_tip()
+        m300.aspirate(50, location)
+
+`LiquidTracker` keeps the volume of every well in one array and turns it
+into liquid heights with the geometry of the labware definition instead
+of a straight cylinder. Wells have a constant cross-section down to a
+bottom shaped by the `wellBottomShape` of their group: a cone (or
+pyramid) for `v`, a paraboloid for `u` and nothing for `flat`. The
+height of the bottom is whatever makes the well hold its
+`totalLiquidVolume`.
+
+A pipette aimed at a well with `channels` > 1 takes from every well under
+its channels, 9 mm apart: the 8 wells of a 96 well column, every other
+well of a 384 well column, or 8 times from the same reservoir well. As in
+opentrons, the channels are centred on the well for labware with the
+`centerMultichannelOnWells` quirk (reservoirs), and start at the well
+otherwise.
+Locations are the well bottom plus the liquid height after aspirating,
+less `immersion`, and never closer to the bottom than `min_height`.
+"""
+import math
+
+import numpy as np
+
+CHANNEL_SPACING = 9.0
+CENTER_QUIRK = 'centerMultichannelOnWells'
+# the volume in the bottom of a well grows with its height ** exponent
+BOTTOM_EXPONENTS = {'v': 3.0, 'u': 2.0, 'flat': 1.0}
+
+
+def labware_definition(labware):
+    implementation = getattr(labware, '_implementation', None)
+    if implementation is not None:
+        return implementation.get_definition()
+    return labware._definition
+
+
+def well_name(well):
+    if isinstance(well, str):
+        return well
+    name = getattr(well, 'well_name', None)
+    return name or well.display_name.split(' ')[0]
+
+
+def cross_section(well):
+    if well['shape'] == 'circular':
+        return math.pi * (well['diameter'] / 2) ** 2
+    return well['xDimension'] * well['yDimension']
+
+
+def contains(well, x, y):
+    if well['shape'] == 'circular':
+        return math.hypot(x - well['x'], y - well['y']) <= well['diameter'] / 2
+    return (abs(x - well['x']) <= well['xDimension'] / 2 and
+            abs(y - well['y']) <= well['yDimension'] / 2)
+
+
+def well_geometry(definition):
+    """
+    Returns the names of the wells of :param:definition, and arrays of
+    their cross-section, depth, bottom height and bottom exponent.
+    """
+    shapes = {}
+    for group in definition.get('groups', []):
+        shape = group.get('metadata', {}).get('wellBottomShape', 'flat')
+        for name in group['wells']:
+            shapes[name] = shape
+    names = [name for column in definition['ordering'] for name in column]
+    wells = definition['wells']
+    areas = np.array([cross_section(wells[name]) for name in names])
+    depths = np.array([wells[name]['depth'] for name in names], dtype=float)
+    capacities = np.array(
+        [wells[name]['totalLiquidVolume'] for name in names], dtype=float)
+    exponents = np.array([
+        BOTTOM_EXPONENTS.get(shapes.get(name), 1.0) for name in names])
+    # a bottom of height b holds area * b / exponent instead of area * b
+    missing = np.maximum(areas * depths - capacities, 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bottoms = np.where(
+            exponents > 1, missing * exponents / (areas * (exponents - 1)),
+            0.0)
+    bottoms = np.clip(np.nan_to_num(bottoms), 0.0, depths)
+    return names, areas, depths, bottoms, exponents
+
+
+class LiquidTracker(object):
+    def __init__(self, labware, volumes=0.0, definition=None,
+                 immersion=2.0, min_height=1.0):
+        self.labware = labware
+        definition = definition or labware_definition(labware)
+        self.wells = definition['wells']
+        (self.names, self.areas, self.depths, self.bottoms,
+         self.exponents) = well_geometry(definition)
+        self.indices = {name: i for i, name in enumerate(self.names)}
+        self.centered = CENTER_QUIRK in definition.get(
+            'parameters', {}).get('quirks', [])
+        self.volumes = np.zeros(len(self.names))
+        self.volumes[:] = volumes
+        self.immersion = immersion
+        self.min_height = min_height
+        self._channel_wells = {}
+
+    def heights(self, volumes=None):
+        """
+        Returns the liquid height of every well for :param:volumes, by
+        default the current volumes.
+        """
+        volumes = np.maximum(
+            self.volumes if volumes is None else volumes, 0.0)
+        bottom_volumes = self.areas * self.bottoms / self.exponents
+        with np.errstate(divide='ignore', invalid='ignore'):
+            in_bottom = self.bottoms * np.power(
+                volumes / bottom_volumes, 1 / self.exponents)
+        above = self.bottoms + (volumes - bottom_volumes) / self.areas
+        heights = np.where(volumes < bottom_volumes, in_bottom, above)
+        return np.minimum(np.nan_to_num(heights), self.depths)
+
+    def channel_wells(self, name, channels):
+        """
+        Returns the indices of the wells under each of :param:channels
+        channels aimed at well :param:name.
+        """
+        key = (name, channels)
+        if key not in self._channel_wells:
+            top = self.wells[name]
+            under = []
+            # channel 0 is the back one, at the largest y
+            first = (channels - 1) / 2 if self.centered else 0
+            for channel in range(channels):
+                y = top['y'] - (channel - first) * CHANNEL_SPACING
+                under.extend(
+                    self.indices[other] for other in self.names
+                    if contains(self.wells[other], top['x'], y))
+            self._channel_wells[key] = np.array(under, dtype=int)
+        return self._channel_wells[key]
+
+    def _targets(self, wells, channels):
+        single = not isinstance(wells, (list, tuple))
+        wells = [wells] if single else list(wells)
+        names = [well_name(well) for well in wells]
+        return single, wells, [
+            self.channel_wells(name, channels) for name in names]
+
+    def _well(self, well):
+        if isinstance(well, str):
+            return self.labware.wells_by_name()[well]
+        return well
+
+    def set_volume(self, wells, volume, channels=1):
+        _, _, targets = self._targets(wells, channels)
+        for under in targets:
+            self.volumes[under] = volume
+
+    def aspirate(self, wells, volume, channels=1):
+        """
+        Takes :param:volume from every channel aimed at :param:wells and
+        returns where to aspirate it from, a location for a single well
+        and a list of locations for a list of wells.
+        """
+        single, wells, targets = self._targets(wells, channels)
+        under = np.concatenate(targets)
+        np.subtract.at(self.volumes, under, volume)
+        heights = self.heights() - self.immersion
+        locations = [
+            self._well(well).bottom(
+                max(float(heights[indices].min()), self.min_height))
+            for well, indices in zip(wells, targets)]
+        return locations[0] if single else locations
+
+    def dispense(self, wells, volume, channels=1, above=1.0):
+        """
+        Adds :param:volume under every channel aimed at :param:wells and
+        returns locations :param:above mm over the new liquid surface.
+        """
+        single, wells, targets = self._targets(wells, channels)
+        under = np.concatenate(targets)
+        np.add.at(self.volumes, under, volume)
+        heights = np.minimum(self.heights() + above, self.depths)
+        locations = [
+            self._well(well).bottom(float(heights[indices].max()))
+            for well, indices in zip(wells, targets)]
+        return locations[0] if single else locations
+
+    def volume(self, well):
+        return float(self.volumes[self.indices[well_name(well)]])
@@ -0,0 +1,171 @@
+"""
+Tip tracking that survives aborted runs.
+
+Protocols that keep using partially used tip racks between runs used to
+read a `tip_log.json` at the start of the run and only write it back at
+the end, so a run that crashed or was cancelled lost track of every tip
+it picked up. `TipTracker` writes a line to a journal on every pickup
+instead:
+
+    {"counts": {"left:p300_multi_gen2": 24, "right:p1000_single_gen2": 3}}
+    {"left:p300_multi_gen2": 25}
+    {"left:p300_multi_gen2": 26}
+
+The first line is a snapshot of the next tip of every pipette, keyed by
+its mount and name unless `add` is given a `key`, the rest are pickups
+since. A pickup line holds the index of the next tip, so
+replaying the journal is just keeping the last value of each pipette,
+and a line cut short by a crash only loses that pickup. Every
+`compact_every` pickups, and when the run ends, the journal is rewritten
+as a single snapshot.
+
+    tips = TipTracker(ctx, '/data/B/tip_log.jsonl', enabled=tip_track)
+    tips.add(m300, tips300)
+    tips.add(p1000, tips1000)
+
+    tips.pick_up(m300)
+    ...
+    tips.close()
+
+Multichannel pipettes pick up tips a column at a time (the top row of
+each rack), single channel pipettes a well at a time, rack after rack.
+When a pipette runs out of tips the run pauses for the racks to be
+replaced. Give each pipette its own racks. The journal is not read or
+written while simulating.
+"""
+import json
+import os
+
+COMPACT_EVERY = 96
+
+
+def tip_order(pipette, tipracks):
+    """
+    Returns the tips of :param:tipracks in the order :param:pipette picks
+    them up.
+    """
+    if getattr(pipette, 'channels', 1) > 1:
+        return [tip for rack in tipracks for tip in rack.rows()[0]]
+    return [tip for rack in tipracks for tip in rack.wells()]
+
+
+def read_journal(path):
+    """
+    Returns the next tip index of every pipette recorded in :param:path.
+    """
+    counts = {}
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return counts
+    for line in lines:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            # the last line of a run that stopped while writing it
+            continue
+        if not isinstance(entry, dict):
+            continue
+        counts.update(entry.get('counts', entry))
+    return {
+        key: count for key, count in counts.items()
+        if isinstance(count, int)}
+
+
+def write_snapshot(path, counts):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w') as f:
+        f.write(json.dumps({'counts': counts}, sort_keys=True) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary_path, path)
+
+
+class TipTracker(object):
+    def __init__(self, ctx, path, enabled=True, compact_every=COMPACT_EVERY):
+        self.ctx = ctx
+        self.path = path
+        self.enabled = enabled and not ctx.is_simulating()
+        self.compact_every = compact_every
+        self.tips = {}
+        self.counts = {}
+        self.saved = read_journal(path) if self.enabled else {}
+        self.pending = 0
+        self.journal = None
+
+    def key(self, pipette):
+        return '{}:{}'.format(pipette.mount, pipette.name)
+
+    def add(self, pipette, tipracks, key=None):
+        """
+        Tracks the tips of :param:tipracks for :param:pipette, starting
+        from the tip after the last one it picked up in an earlier run.
+        """
+        key = key or self.key(pipette)
+        self.tips[pipette] = (key, tip_order(pipette, tipracks))
+        count = self.saved.get(key, 0)
+        self.counts[pipette] = count if count < len(
+            self.tips[pipette][1]) else 0
+
+    def next_tip(self, pipette):
+        key, tips = self.tips[pipette]
+        if self.counts[pipette] >= len(tips):
+            self.ctx.pause('Replace {}µl tipracks before resuming.'.format(
+                pipette.max_volume))
+            pipette.reset_tipracks()
+            self.counts[pipette] = 0
+            self.record(pipette)
+        return tips[self.counts[pipette]]
+
+    def pick_up(self, pipette, location=None):
+        """
+        Picks up the next tip of :param:pipette, or the tip at
+        :param:location without tracking it.
+        """
+        if location is not None:
+            pipette.pick_up_tip(location)
+            return
+        pipette.pick_up_tip(self.next_tip(pipette))
+        self.counts[pipette] += 1
+        self.record(pipette)
+
+    def record(self, pipette):
+        if not self.enabled:
+            return
+        if self.journal is None or self.pending >= self.compact_every:
+            self.compact()
+            return
+        key = self.tips[pipette][0]
+        self.journal.write(
+            json.dumps({key: self.counts[pipette]}) + '\n')
+        self.journal.flush()
+        self.pending += 1
+
+    def snapshot(self):
+        counts = dict(self.saved)
+        counts.update(
+            (key, self.counts[pipette])
+            for pipette, (key, _) in self.tips.items())
+        return counts
+
+    def compact(self):
+        """
+        Rewrites the journal as a snapshot of the current counts.
+        """
+        if not self.enabled:
+            return
+        if self.journal is not None:
+            self.journal.close()
+        write_snapshot(self.path, self.snapshot())
+        self.journal = open(self.path, 'a')
+        self.pending = 0
+
+    def close(self):
+        if self.enabled:
+            self.compact()
+            self.journal.close()
+            self.journal = None
@@ -5,5 +5,6 @@ setup(
     version='0.1',
     author='Opentrons',
     packages=find_packages(),
+    install_requires=['numpy'],
     zip_safe=False
 )
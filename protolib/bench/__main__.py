@@ -0,0 +1,67 @@
+"""
+Benchmark the protolib build pipeline.
+
+    python -m protolib.bench run [--stages readme,merge] [--sample 50] \
+        [-o bench.json]
+    python -m protolib.bench compare base.json new.json [--threshold 0.1]
+"""
+import argparse
+import json
+import sys
+
+from protolib.bench.report import compare, run_benchmark
+from protolib.bench.stages import STAGES
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(prog='python -m protolib.bench')
+    commands = arg_parser.add_subparsers(dest='command')
+
+    run_parser = commands.add_parser(
+        'run', help='benchmark pipeline stages and print a JSON report')
+    run_parser.add_argument(
+        '--stages', default=','.join(STAGES),
+        help='comma separated stages (default: {})'.format(','.join(STAGES)))
+    run_parser.add_argument(
+        '--sample', type=int, default=None,
+        help='only use this many protocols, spread evenly over the tree')
+    run_parser.add_argument(
+        '--slowest', type=int, default=10,
+        help='number of slowest protocols to list per stage')
+    run_parser.add_argument(
+        '-o', '--output', help='write the report here instead of stdout')
+
+    compare_parser = commands.add_parser(
+        'compare', help='compare two reports, fail on regressions')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument(
+        '--threshold', type=float, default=0.1,
+        help='allowed slowdown as a fraction (default: 0.1)')
+
+    args = arg_parser.parse_args(argv)
+
+    if args.command == 'compare':
+        with open(args.base) as base, open(args.new) as new:
+            regressions = compare(json.load(base), json.load(new),
+                                  args.threshold)
+        return 1 if regressions else 0
+
+    if args.command != 'run':
+        arg_parser.print_help()
+        return 2
+    stage_names = args.stages.split(',')
+    unknown = set(stage_names) - set(STAGES)
+    if unknown:
+        arg_parser.error('unknown stages: {}'.format(', '.join(unknown)))
+
+    report = run_benchmark(stage_names, args.sample, args.slowest)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
+    return 0
+
+
+sys.exit(main())
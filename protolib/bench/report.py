@@ -0,0 +1,108 @@
+"""
+Runs benchmark stages in isolated processes, summarizes them as JSON
+and compares two benchmark runs.
+"""
+import contextlib
+import os
+import platform
+import resource
+import statistics
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from protolib.bench.stages import STAGES
+
+# metrics where a bigger number in the new run is a regression
+REGRESSION_METRICS = ['wall_seconds', 'median_seconds', 'peak_rss_kb']
+
+
+def peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, kilobytes elsewhere
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def percentile(sorted_values, fraction):
+    last = len(sorted_values) - 1
+    return sorted_values[min(last, int(round(fraction * last)))]
+
+
+def run_stage(name, sample_size):
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        try:
+            result = STAGES[name](sample_size)
+        except ImportError as e:
+            return {'skipped': str(e)}
+        wall_seconds = time.perf_counter() - start
+    return {
+        **result,
+        'wall_seconds': wall_seconds,
+        'peak_rss_kb': peak_rss_kb()}
+
+
+def summarize(result, slowest):
+    """
+    Reduces the per-item timings of a stage to their distribution
+    and the :param:slowest slowest items.
+    """
+    if 'skipped' in result:
+        return result
+    timings = result.pop('timings')
+    seconds = sorted(timings.values())
+    result['items'] = len(seconds)
+    if seconds:
+        result.update({
+            'mean_seconds': statistics.mean(seconds),
+            'median_seconds': statistics.median(seconds),
+            'p90_seconds': percentile(seconds, 0.9),
+            'min_seconds': seconds[0],
+            'max_seconds': seconds[-1]})
+    result['slowest'] = sorted(
+        timings.items(), key=lambda item: item[1], reverse=True)[:slowest]
+    return result
+
+
+def run_benchmark(stage_names, sample_size=None, slowest=10):
+    """
+    Runs each stage in a fresh process, so that its peak RSS is its own.
+    """
+    stages = {}
+    for name in stage_names:
+        print('bench: running {}...'.format(name), file=sys.stderr)
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            result = executor.submit(run_stage, name, sample_size).result()
+        stages[name] = summarize(result, slowest)
+    return {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sample': sample_size,
+        'stages': stages
+    }
+
+
+def compare(base, new, threshold):
+    """
+    Prints how every stage metric changed from :param:base to :param:new.
+    Returns the (stage, metric) pairs that got more than :param:threshold
+    (a fraction) worse.
+    """
+    regressions = []
+    for name in sorted(set(base['stages']) & set(new['stages'])):
+        base_stage = base['stages'][name]
+        new_stage = new['stages'][name]
+        for metric in REGRESSION_METRICS + ['output_bytes', 'items']:
+            if metric not in base_stage or metric not in new_stage:
+                continue
+            before, after = base_stage[metric], new_stage[metric]
+            change = (after - before) / before if before else 0.0
+            flag = ''
+            if metric in REGRESSION_METRICS and change > threshold:
+                regressions.append((name, metric))
+                flag = '  <-- REGRESSION'
+            print('{:<10} {:<16} {:>14.4f} {:>14.4f} {:>+8.1%}{}'.format(
+                name, metric, before, after, change, flag))
+    return regressions
@@ -0,0 +1,123 @@
+"""
+Stages of the protolib build pipeline, instrumented for benchmarking.
+
+Each stage runs over the real `protocols/` tree, or over a fixed sample of
+it, and returns how long every item took along with the size of what the
+stage produced. Apart from `merge`, which builds a release like
+`python -m protolib`, no stage writes anything to disk.
+"""
+import json
+import os
+import shutil
+import time
+
+from protolib.traversals import (
+    PROTOCOL_DIR, PROTOCOLS_BUILD_DIR, RELEASES_DIR, find_ot2_protocols)
+
+
+def sample(items, size):
+    """
+    Returns :param:size items spread evenly over the sorted :param:items,
+    so that every run benchmarks the same protocols.
+    """
+    items = sorted(items)
+    if not size or size >= len(items):
+        return items
+    step = len(items) / size
+    return [items[int(i * step)] for i in range(size)]
+
+
+def time_items(items, fn):
+    """
+    Calls :param:fn on every item, which returns the size in bytes
+    of its output.
+    """
+    timings = {}
+    errors = {}
+    output_bytes = 0
+    for item in items:
+        start = time.perf_counter()
+        try:
+            output_bytes += fn(item)
+        except Exception as e:
+            errors[str(item)] = '{}: {}'.format(type(e).__name__, e)
+        timings[str(item)] = time.perf_counter() - start
+    return {'timings': timings, 'output_bytes': output_bytes, 'errors': errors}
+
+
+def protocol_dirs():
+    return [
+        entry.name for entry in os.scandir(PROTOCOL_DIR) if entry.is_dir()]
+
+
+def simulate(sample_size):
+    # imported here so the other stages can run without opentrons
+    from protolib.parse import parseOT2v2
+    hardware = parseOT2v2.build_hardware()
+
+    def run(protocol_path):
+        parseOT2v2.reset_hardware(hardware)
+        result = parseOT2v2.parse(str(protocol_path), hardware=hardware)
+        return len(json.dumps(result, sort_keys=True, separators=(',', ':')))
+
+    return time_items(sample(find_ot2_protocols(), sample_size), run)
+
+
+def readme(sample_size):
+    from protolib.parse import markdown as parser
+
+    def run(root):
+        result = parser.parse(os.path.join(PROTOCOL_DIR, root, 'README.md'))
+        return len(json.dumps(result, indent=4, sort_keys=True))
+
+    return time_items(sample(protocol_dirs(), sample_size), run)
+
+
+def metadata(sample_size):
+    from protolib.traverse_errors import generate_metadata, get_status
+
+    def run(root):
+        with os.scandir(os.path.join(PROTOCOL_DIR, root)) as files:
+            file_names = [f.name for f in files]
+        metadata = generate_metadata(root, PROTOCOL_DIR, file_names)
+        return len(json.dumps(
+            {**metadata, 'status': get_status(metadata)},
+            indent=4, sort_keys=True))
+
+    return time_items(sample(protocol_dirs(), sample_size), run)
+
+
+def merge(sample_size):
+    # the merge always covers all of protoBuilds, so it is timed as a whole,
+    # once without and once with the records cached by the first run
+    from protolib import merge
+
+    shutil.rmtree(merge.MERGE_CACHE_DIR, ignore_errors=True)
+    timings = {}
+    for run in ('cold', 'warm'):
+        start = time.perf_counter()
+        zip_path = merge.merge_protocols(PROTOCOLS_BUILD_DIR)
+        timings[run] = time.perf_counter() - start
+
+    outputs = {
+        'output.json': os.path.getsize(
+            os.path.join(RELEASES_DIR, 'output.json')),
+        merge.INDEX_NAME: os.path.getsize(
+            os.path.join(RELEASES_DIR, merge.INDEX_NAME)),
+        'zip': os.path.getsize(zip_path)
+    }
+    # don't leave a benchmark build behind for deployment
+    os.remove(zip_path)
+    return {
+        'timings': timings,
+        'output_bytes': outputs['zip'],
+        'outputs': outputs,
+        'errors': {}}
+
+
+STAGES = {
+    'simulate': simulate,
+    'readme': readme,
+    'metadata': metadata,
+    'merge': merge
+}
@@ -0,0 +1,302 @@
+"""
+Inline shared helpers into protocol files.
+
+The robot only runs single, self-contained protocol files, so protocols
+can't import helpers that are not installed on it. Instead, a protocol may
+import helpers from the `otcustomizers` package:
+
+    from otcustomizers.tips import TipTracker
+
+and the build replaces that import with the source of the helpers, keeping
+only the top level functions, classes, assignments and imports of the
+helper module that the imported names need. Helpers can import other
+helpers the same way. The bundled file is what gets simulated and what
+the library serves as the protocol `content`.
+
+Bundles are cached in `protoBuilds/_store/bundle/`, keyed by the hash of
+the protocol source and of every helper module it pulls in.
+
+    python -m protolib.bundle PROTOCOL [-o OUTPUT]
+"""
+import argparse
+import ast
+import hashlib
+import json
+import os
+import sys
+
+from protolib import store
+
+HELPER_PACKAGE = 'otcustomizers'
+HELPERS_DIR = os.path.join('otcustomizers', HELPER_PACKAGE)
+
+
+class BundleError(Exception):
+    pass
+
+
+def helper_path(module):
+    """
+    Returns the source file of the helper module :param:module.
+    """
+    parts = module.split('.')
+    if parts[0] != HELPER_PACKAGE:
+        raise BundleError('{} is not a helper module'.format(module))
+    path = os.path.join(HELPERS_DIR, *parts[1:])
+    if os.path.isfile(path + '.py'):
+        return path + '.py'
+    if os.path.isfile(os.path.join(path, '__init__.py')):
+        return os.path.join(path, '__init__.py')
+    raise BundleError('no helper module {}'.format(module))
+
+
+def is_helper_import(node):
+    if isinstance(node, ast.ImportFrom):
+        return node.level == 0 and node.module is not None and (
+            node.module.split('.')[0] == HELPER_PACKAGE)
+    if isinstance(node, ast.Import):
+        return any(alias.name.split('.')[0] == HELPER_PACKAGE
+                   for alias in node.names)
+    return False
+
+
+def statement_lines(lines, tree):
+    """
+    Yields (node, start, end) line slices of the top level statements of
+    :param:tree, with their decorators and the comments right above. A
+    statement ends where the next begins, less trailing blank lines.
+    """
+    starts = [
+        min([node.lineno] + [
+            decorator.lineno
+            for decorator in getattr(node, 'decorator_list', [])]) - 1
+        for node in tree.body]
+    for i in range(1, len(starts)):
+        while starts[i] - 1 > starts[i - 1] and \
+                lines[starts[i] - 1].lstrip().startswith('#'):
+            starts[i] -= 1
+    for i, node in enumerate(tree.body):
+        end = starts[i + 1] if i + 1 < len(tree.body) else len(lines)
+        while end > starts[i] + 1 and not lines[end - 1].strip():
+            end -= 1
+        yield node, starts[i], end
+
+
+def defined_names(node):
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef,
+                         ast.ClassDef)):
+        return {node.name}
+    if isinstance(node, (ast.Import, ast.ImportFrom)):
+        return {(alias.asname or alias.name).split('.')[0]
+                for alias in node.names}
+    targets = []
+    if isinstance(node, ast.Assign):
+        targets = node.targets
+    elif isinstance(node, (ast.AnnAssign, ast.AugAssign)):
+        targets = [node.target]
+    return {
+        name.id for target in targets for name in ast.walk(target)
+        if isinstance(name, ast.Name)}
+
+
+def used_names(node):
+    return {name.id for name in ast.walk(node) if isinstance(name, ast.Name)}
+
+
+def shake(module, names, seen, imports):
+    """
+    Returns the source of the parts of helper :param:module that
+    :param:names need, preceded by the helpers those parts import. The
+    imports they need are added to :param:imports.
+    """
+    with open(helper_path(module)) as f:
+        source = f.read()
+    lines = source.splitlines()
+    tree = ast.parse(source)
+    docstring = tree.body[0] if ast.get_docstring(tree) is not None else None
+    statements = []
+    definitions = {}
+    for node, start, end in statement_lines(lines, tree):
+        if node is docstring or (isinstance(node, ast.ImportFrom) and
+                                 node.module == '__future__'):
+            continue
+        statements.append((node, start, end))
+        for name in defined_names(node):
+            definitions.setdefault(name, []).append(len(statements) - 1)
+
+    keep = set()
+    pending = list(names)
+    while pending:
+        name = pending.pop()
+        if name in definitions:
+            for index in definitions[name]:
+                if index not in keep:
+                    keep.add(index)
+                    pending.extend(used_names(statements[index][0]))
+    missing = [name for name in names if name not in definitions]
+    if missing:
+        raise BundleError('{} has no {}'.format(module, ', '.join(missing)))
+
+    parts = []
+    for index in sorted(keep):
+        node, start, end = statements[index]
+        text = '\n'.join(lines[start:end])
+        if is_helper_import(node):
+            parts.insert(0, inline_import(node, seen, imports))
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            if text not in imports:
+                imports.append(text)
+        elif (module, index) not in seen:
+            seen.add((module, index))
+            parts.append(text)
+    return '\n\n\n'.join(part for part in parts if part)
+
+
+def inline_import(node, seen, imports):
+    """
+    Returns the source that replaces the helper import :param:node, or ''
+    if everything it imports is already inlined.
+    """
+    if not isinstance(node, ast.ImportFrom):
+        raise BundleError(
+            'line {}: import helpers with `from {}... import ...`'.format(
+                node.lineno, HELPER_PACKAGE))
+    names = [alias.name for alias in node.names]
+    if '*' in names:
+        raise BundleError('line {}: star imports of helpers can\'t be '
+                          'inlined'.format(node.lineno))
+    source = shake(node.module, names, seen, imports)
+    aliases = '\n'.join(
+        '{} = {}'.format(alias.asname, alias.name) for alias in node.names
+        if alias.asname and alias.asname != alias.name)
+    parts = [part for part in (source, aliases) if part]
+    if not parts:
+        return ''
+    return '# inlined from {}\n'.format(node.module) + '\n\n\n'.join(parts)
+
+
+def helper_imports(source):
+    """
+    Returns the top level helper imports of :param:source.
+    """
+    if HELPER_PACKAGE not in source:
+        return []
+    return [node for node in ast.parse(source).body
+            if is_helper_import(node)]
+
+
+def helper_modules(source, seen=None):
+    """
+    Returns the helper modules :param:source imports, directly or not.
+    """
+    seen = [] if seen is None else seen
+    for node in helper_imports(source):
+        module = getattr(node, 'module', None) or node.names[0].name
+        if module not in seen:
+            seen.append(module)
+            with open(helper_path(module)) as f:
+                helper_modules(f.read(), seen)
+    return seen
+
+
+def bundle(source):
+    """
+    Returns :param:source with its helper imports replaced by the helpers.
+    The imports the helpers need go where the first helper import was.
+    """
+    if not helper_imports(source):
+        return source
+    lines = source.splitlines()
+    tree = ast.parse(source)
+    # helpers may import the same modules as the protocol
+    protocol_names = set().union(*(
+        defined_names(node) for node in tree.body
+        if not isinstance(node, (ast.Import, ast.ImportFrom))))
+    protocol_imports = {
+        lines[node.lineno - 1].strip() for node in tree.body
+        if isinstance(node, (ast.Import, ast.ImportFrom))}
+    seen = set()
+    imports = []
+    replaced = {}
+    for node, start, end in statement_lines(lines, tree):
+        if is_helper_import(node):
+            replaced[start] = [end, inline_import(node, seen, imports)]
+
+    inlined = ast.parse('\n'.join(
+        imports + [text for _, text in replaced.values()]))
+    clashes = protocol_names & set().union(*(
+        defined_names(node) for node in inlined.body))
+    if clashes:
+        raise BundleError('helpers redefine {}'.format(
+            ', '.join(sorted(clashes))))
+    first = min(replaced)
+    replaced[first][1] = '\n\n\n'.join(part for part in [
+        '\n'.join(text for text in imports
+                  if text not in protocol_imports),
+        replaced[first][1]] if part)
+
+    output = []
+    i = 0
+    while i < len(lines):
+        if i in replaced:
+            end, text = replaced[i]
+            if text:
+                output.extend([text, '', ''])
+            i = end
+            while i < len(lines) and not lines[i].strip():
+                i += 1
+        else:
+            output.append(lines[i])
+            i += 1
+    return '\n'.join(output) + '\n'
+
+
+def bundle_key(source):
+    digest = hashlib.sha256(source.encode('utf-8'))
+    for module in helper_modules(source):
+        with open(helper_path(module), 'rb') as f:
+            digest.update(module.encode('utf-8') + b'\0' + f.read())
+    return digest.hexdigest()
+
+
+def cached_bundle(source):
+    """
+    Returns the bundle of :param:source, from the store if it was already
+    built from the same protocol and helper sources.
+    """
+    if not helper_imports(source):
+        return source
+    key = bundle_key(source)
+    try:
+        return json.loads(store.read_blob(store.BUNDLE, key))
+    except FileNotFoundError:
+        bundled = bundle(source)
+        store.put_json(store.BUNDLE, bundled, key)
+        return bundled
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(
+        prog='python -m protolib.bundle',
+        description='Inline otcustomizers helpers into a protocol file.')
+    arg_parser.add_argument('protocol', help='protocol file to bundle')
+    arg_parser.add_argument(
+        '-o', '--output', help='write the bundle here instead of stdout')
+    args = arg_parser.parse_args(argv)
+    with open(args.protocol) as f:
+        source = f.read()
+    try:
+        bundled = bundle(source)
+    except BundleError as e:
+        print('{}: {}'.format(args.protocol, e), file=sys.stderr)
+        return 1
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(bundled)
+    else:
+        sys.stdout.write(bundled)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
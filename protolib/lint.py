@@ -0,0 +1,240 @@
+"""
+Static checks of OT2 APIv2 protocols, without simulating them.
+
+Each `.ot2.apiv2.py` is parsed with `ast` to extract its metadata, the
+field names passed to `get_values(...)` and the literal arguments of its
+`load_labware`, `load_module` and `load_instrument` calls. These are
+checked against the protocol's `fields.json` and `labware/` folder:
+
+- errors: syntax errors, a missing `apiLevel`, `get_values` names that are
+  not in `fields.json`, deck slots that don't exist
+- warnings: fields that are never read, custom labware that is never
+  loaded, several deck loads into the same slot
+
+    python -m protolib.lint [-j JOBS] [--json] [PROTOCOL ...]
+
+exits with an error if any protocol has errors. `--json` prints everything
+that was extracted instead.
+"""
+import argparse
+import ast
+import json
+import sys
+from collections import Counter
+from multiprocessing import Pool
+from pathlib import Path
+
+from protolib.traversals import find_ot2_protocols
+
+DECK_SLOTS = {str(slot) for slot in range(1, 13)}
+LOAD_METHODS = {
+    'load_labware': ('load_name', 'location'),
+    'load_labware_from_definition': ('labware_def', 'location'),
+    'load_module': ('module_name', 'location'),
+    'load_instrument': ('instrument_name', 'mount'),
+}
+
+
+def literal(node):
+    # works for both ast.Constant and the ast.Str/ast.Num of python 3.7
+    try:
+        return ast.literal_eval(node)
+    except (ValueError, TypeError, SyntaxError):
+        return None
+
+
+def call_argument(call, index, keyword):
+    if len(call.args) > index and not any(
+            isinstance(arg, ast.Starred) for arg in call.args[:index + 1]):
+        return call.args[index]
+    for kw in call.keywords:
+        if kw.arg == keyword:
+            return kw.value
+    return None
+
+
+def context_name(tree):
+    """
+    Returns the name of the protocol context argument of `run`.
+    """
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and node.name == 'run' and \
+                node.args.args:
+            return node.args.args[0].arg
+    return None
+
+
+def extract(source):
+    """
+    Returns the metadata, `get_values` names and load calls of the
+    protocol :param:source.
+    """
+    tree = ast.parse(source)
+    metadata = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(
+                isinstance(target, ast.Name) and
+                target.id in ('metadata', 'requirements')
+                for target in node.targets):
+            value = literal(node.value)
+            if isinstance(value, dict):
+                metadata.update(value)
+
+    ctx = context_name(tree)
+    field_names = []
+    loads = []
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        func = node.func
+        if isinstance(func, ast.Name) and func.id == 'get_values':
+            for arg in node.args:
+                name = literal(arg)
+                if isinstance(name, str):
+                    field_names.append((name, node.lineno))
+        elif isinstance(func, ast.Attribute) and func.attr in LOAD_METHODS:
+            name_keyword, location_keyword = LOAD_METHODS[func.attr]
+            name = call_argument(node, 0, name_keyword)
+            location = call_argument(node, 1, location_keyword)
+            loads.append({
+                'method': func.attr,
+                'name': literal(name) if name is not None else None,
+                'location': (
+                    literal(location) if location is not None else None),
+                # labware loaded onto a module has no deck slot of its own
+                'on_deck': isinstance(func.value, ast.Name) and
+                func.value.id == ctx,
+                'line': node.lineno})
+    return {'metadata': metadata, 'fields': field_names, 'loads': loads}
+
+
+def custom_load_names(protocol_dir):
+    load_names = {}
+    for path in sorted((protocol_dir / 'labware').glob('*.json')):
+        try:
+            with open(path) as f:
+                load_names[json.load(f)['parameters']['loadName']] = path.name
+        except (ValueError, KeyError, TypeError):
+            continue
+    return load_names
+
+
+def lint(protocol_path):
+    """
+    Returns the extracted data, errors and warnings of one protocol.
+    Errors and warnings are (line, message) pairs.
+    """
+    protocol_path = Path(protocol_path)
+    errors = []
+    warnings = []
+    source = protocol_path.read_text()
+    try:
+        extracted = extract(source)
+    except SyntaxError as e:
+        return {}, [(e.lineno, 'syntax error: {}'.format(e.msg))], []
+
+    if 'apiLevel' not in extracted['metadata']:
+        errors.append((1, "metadata['apiLevel'] is not set"))
+
+    fields_path = protocol_path.parent / 'fields.json'
+    field_names = set()
+    fields_text = ''
+    if fields_path.is_file():
+        fields_text = fields_path.read_text()
+        try:
+            field_names = {
+                field['name'] for field in json.loads(fields_text)}
+        except (ValueError, KeyError, TypeError) as e:
+            errors.append((None, 'invalid fields.json: {}'.format(e)))
+    elif extracted['fields']:
+        errors.append((
+            extracted['fields'][0][1],
+            'get_values is called but there is no fields.json'))
+    used_names = {name for name, _ in extracted['fields']}
+    for name, line in extracted['fields']:
+        if field_names and name not in field_names:
+            errors.append((line, 'field "{}" is not in fields.json'.format(
+                name)))
+    for name in sorted(field_names - used_names):
+        warnings.append((None, 'field "{}" is never read'.format(name)))
+
+    slots = Counter()
+    for load in extracted['loads']:
+        slot = load['location']
+        if not load['on_deck'] or load['method'] == 'load_instrument' or \
+                slot is None:
+            continue
+        if str(slot) not in DECK_SLOTS:
+            errors.append((load['line'], '{} into unknown slot {!r}'.format(
+                load['method'], slot)))
+        slots[str(slot)] += 1
+    for slot, count in sorted(slots.items()):
+        if count > 1:
+            warnings.append((None, '{} loads into slot {}'.format(
+                count, slot)))
+
+    # load names also come from dropDown options or other variables,
+    # so any mention of a custom load name counts as loading it
+    mentions = source + fields_text
+    for load_name, file_name in custom_load_names(
+            protocol_path.parent).items():
+        if load_name not in mentions:
+            warnings.append((None, 'custom labware {} ({}) is never '
+                                   'loaded'.format(file_name, load_name)))
+    return extracted, errors, warnings
+
+
+def _lint_one(protocol_path):
+    return (str(protocol_path),) + lint(protocol_path)
+
+
+def format_problem(protocol_path, line, level, message):
+    if line is None:
+        return '{}: {}: {}'.format(protocol_path, level, message)
+    return '{}:{}: {}: {}'.format(protocol_path, line, level, message)
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(
+        prog='python -m protolib.lint',
+        description='Check OT2 APIv2 protocols without simulating them.')
+    arg_parser.add_argument(
+        'protocols', nargs='*',
+        help='protocol files to check (default: every OT2 APIv2 protocol)')
+    arg_parser.add_argument(
+        '-j', '--jobs', type=int, default=None,
+        help='number of worker processes (default: number of CPUs)')
+    arg_parser.add_argument(
+        '--json', action='store_true',
+        help='print the extracted metadata, fields and loads as JSON')
+    arg_parser.add_argument(
+        '--no-warnings', action='store_true', help='only print errors')
+    args = arg_parser.parse_args(argv)
+
+    protocol_paths = args.protocols or list(find_ot2_protocols())
+    with Pool(args.jobs) as pool:
+        results = pool.map(_lint_one, protocol_paths, chunksize=16)
+
+    if args.json:
+        json.dump(
+            {path: extracted for path, extracted, _, _ in results},
+            sys.stdout, indent=4, sort_keys=True, default=str)
+        print()
+    error_count = 0
+    for path, _, errors, warnings in results:
+        error_count += len(errors)
+        problems = [(line, 'error', message) for line, message in errors]
+        if not args.no_warnings:
+            problems += [
+                (line, 'warning', message) for line, message in warnings]
+        for line, level, message in problems:
+            print(format_problem(path, line, level, message),
+                  file=sys.stderr if args.json else sys.stdout)
+    print('{} protocols checked, {} errors'.format(
+        len(results), error_count),
+        file=sys.stderr if args.json else sys.stdout)
+    return 1 if error_count else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,83 +1,343 @@
 import os
+import re
 import json
+import hashlib
 import zipfile
+from contextlib import contextmanager
+from protolib import store
+from protolib.parse.layouts import LAYOUTS_SUFFIX
+from protolib.parse.samples import SAMPLES_SUFFIX
 from protolib.traversals import RELEASES_DIR, search_directory
 from collections import defaultdict
 from datetime import datetime
 
+# Serialized protocol records from previous merges, named by the digest of
+# the build files they were made from, plus a manifest mapping each build
+# dir to its digest. Build dirs whose files are unchanged are not re-read.
+MERGE_CACHE_DIR = os.path.join(RELEASES_DIR, 'cache')
+MANIFEST_PATH = os.path.join(MERGE_CACHE_DIR, 'manifest.json')
+# bump whenever the shape of manifest entries or what they hash changes
+MANIFEST_VERSION = 4
 
-def zip_file(input_file):
+# Besides the full output.json, the zip holds a lightweight index.json for
+# the category tree and protocol search, one shard per protocol with the
+# full record (source, fields...) and one file per unique custom labware
+# definition, all to be fetched on demand.
+INDEX_NAME = 'index.json'
+SHARD_NAME = 'protocols/{}.json'
+LABWARE_NAME = 'labware/{}.json'
+LAYOUTS_NAME = 'layouts/{}/{}'
+SAMPLES_NAME = 'samples/{}/{}'
+
+# OT 2 builds refer to their source in the store (see parseOT2v2.parse).
+# Keys are never escaped inside a JSON document, so this only matches
+# the key itself and never the text of a string value.
+CONTENT_REF = re.compile(r'"content_ref": "([0-9a-f]{64})"')
+
+
+def deploy_zip_path():
     deploy_path = os.path.join(RELEASES_DIR, 'deploy')
     if not os.path.exists(deploy_path):
         os.mkdir(deploy_path)
-    output_file = os.path.join(
+    return os.path.join(
         deploy_path, 'PL-data-{}.zip'.format(
             datetime.now().strftime("%Y-%m-%d_%H.%M")))
-    with zipfile.ZipFile(output_file, 'w') as zf:
-        zf.write(input_file, 'output.json')
 
 
-def append_to_output(categories, protocols):
+class OutputStream(object):
+    """
+    Writes the release JSON to several binary streams at once, so
+    the whole library never has to be held in memory.
+    """
+    def __init__(self, *streams):
+        self.streams = streams
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        for stream in self.streams:
+            stream.write(data)
+
+
+@contextmanager
+def open_release():
     release_path = os.path.join(RELEASES_DIR, 'output.json')
-    with open(release_path, 'w') as final_file:
-        data = {'categories': categories, 'protocols': protocols}
-        json.dump(data, final_file)
-    zip_file(release_path)
+    with open(release_path, 'wb') as final_file, \
+            zipfile.ZipFile(
+                deploy_zip_path(), 'w',
+                compression=zipfile.ZIP_DEFLATED) as zf:
+        yield final_file, zf
 
 
 def serialize_set(categories):
     return {key: list(value) for key, value in categories.items()}
 
 
-def add_categories(data, metadata, categories, root):
+def get_categories(data, metadata, root):
+    """
+    Returns the (category, subcategory) pairs that a protocol's README
+    contributes to the library's category tree.
+    """
     new_cat = data['categories']
     is_hidden = metadata.get('flags', {}).get('hide-from-search', False)
     if is_hidden:
-        return
-    for key, value in new_cat.items():
-        if value:
-            categories[key].add(value[-1])
-        else:
-            categories[key].add(root.split('/')[-1])
+        return []
+    return [
+        (key, value[-1] if value else root.split('/')[-1])
+        for key, value in new_cat.items()]
+
+
+def add_categories(data, metadata, categories, root):
+    for key, value in get_categories(data, metadata, root):
+        categories[key].add(value)
+
+
+def get_index_entry(record):
+    """
+    Returns the lightweight summary of a protocol record
+    that goes into index.json.
+    """
+    protocols = sum(record['protocols'].values(), [])
+    return {
+        'slug': record['slug'],
+        'title': record.get('title'),
+        'categories': record.get('categories', {}),
+        'flags': record['flags'],
+        'instruments': sorted({
+            instrument['name']
+            for protocol in protocols
+            for instrument in protocol.get('instruments', [])}),
+        'labware': sorted({
+            labware['type']
+            for protocol in protocols
+            for labware in protocol.get('labware', [])}),
+        'shard': SHARD_NAME.format(record['slug'])
+    }
+
+
+def resolve_content(record_text):
+    """
+    Returns the serialized record :param:record_text with every source
+    reference replaced by the source itself, read from the store.
+    """
+    return CONTENT_REF.sub(
+        lambda match: '"content": {}'.format(
+            store.read_blob(store.SOURCE, match.group(1))),
+        record_text)
+
+
+def get_labware_refs(proto_data):
+    """
+    Returns the labware store digests of the custom labware used by a
+    parsed protocol. Builds that still embed their definitions are
+    converted to refer to the store instead.
+    """
+    if 'custom_labware_defs' in proto_data:
+        proto_data['custom_labware_refs'] = [
+            store.put_json(store.LABWARE, labware_def)
+            for labware_def in proto_data.pop('custom_labware_defs')]
+    return proto_data.get('custom_labware_refs', [])
+
+
+def read_protocol(root):
+    """
+    Reads the build files of a single protocol directory.
+    Returns the protocol record (None for empty protocols),
+    its category pairs and the digests of its custom labware.
+    """
+    # Metadata blob
+    with open(os.path.join(root, 'metadata.json'), 'r') as meta:
+        metadata = json.load(meta)
+        status = metadata['status']
+        file_order = metadata['files']
+
+    # README Blob
+    with open(os.path.join(root, 'README.json'), 'r') as md:
+        md_data = json.load(md)
+        categories = get_categories(md_data, metadata, root)
+
+    # Protocol blob
+    metadata['protocols'] = {'OT 1 protocol': [], 'OT 2 protocol': []}
+    labware_refs = set()
+
+    for ot1 in file_order['OT 1 protocol']:
+        with open(os.path.join(root, '{}.json'.format(ot1)), 'r') as proto:
+            proto_data = json.load(proto)
+        metadata['protocols']['OT 1 protocol'].append(proto_data)
+    for ot2 in file_order['OT 2 protocol']:
+        with open(os.path.join(root, '{}.json'.format(ot2)), 'r') as proto:
+            proto_data = json.load(proto)
+        labware_refs.update(get_labware_refs(proto_data))
+        metadata['protocols']['OT 2 protocol'].append(proto_data)
+
+    if status == 'empty':
+        return None, categories, []
+    for key, value in md_data.items():
+        metadata[key] = value
+    return metadata, categories, sorted(labware_refs)
+
+
+def record_inputs(root):
+    """
+    Returns the names of the build files the record of :param:root is read
+    from, including any that the build dir listing leaves out (`test_*`).
+    """
+    with open(os.path.join(root, 'metadata.json'), 'r') as meta:
+        file_order = json.load(meta)['files']
+    return ['metadata.json', 'README.json'] + [
+        '{}.json'.format(name)
+        for kind in ('OT 1 protocol', 'OT 2 protocol')
+        for name in file_order[kind]]
+
+
+def get_file_stats(root, file_names):
+    stats = {}
+    for name in file_names:
+        stat = os.stat(os.path.join(root, name))
+        stats[name] = [stat.st_size, stat.st_mtime_ns]
+    return stats
+
+
+def get_digest(root, file_names):
+    digest = hashlib.sha256()
+    for name in sorted(file_names):
+        digest.update(name.encode('utf-8') + b'\0')
+        with open(os.path.join(root, name), 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                digest.update(chunk)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def record_path(digest):
+    return os.path.join(MERGE_CACHE_DIR, '{}.json'.format(digest))
+
+
+def load_manifest():
+    try:
+        with open(MANIFEST_PATH, 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {}
+    return manifest['entries']
+
+
+def save_manifest(manifest):
+    # drop records that no build dir refers to anymore
+    digests = {entry['digest'] for entry in manifest.values()}
+    for name in os.listdir(MERGE_CACHE_DIR):
+        if name.endswith('.json') and name[:-len('.json')] not in digests:
+            if os.path.join(MERGE_CACHE_DIR, name) != MANIFEST_PATH:
+                os.remove(os.path.join(MERGE_CACHE_DIR, name))
+    with open(MANIFEST_PATH, 'w') as manifest_file:
+        json.dump(
+            {'version': MANIFEST_VERSION, 'entries': manifest},
+            manifest_file, sort_keys=True)
+
+
+def update_entry(entry, root):
+    """
+    Returns the manifest entry for a build dir, re-reading its build files
+    only if they changed since :param:entry was made.
+    """
+    file_names = record_inputs(root)
+    stats = get_file_stats(root, file_names)
+    if entry and entry['stats'] == stats and (
+            entry['empty'] or os.path.exists(record_path(entry['digest']))):
+        return entry
+
+    digest = get_digest(root, file_names)
+    if entry and entry['digest'] == digest and (
+            entry['empty'] or os.path.exists(record_path(digest))):
+        return {**entry, 'stats': stats}
+
+    record, categories, labware_refs = read_protocol(root)
+    if record is not None:
+        with open(record_path(digest), 'w') as record_file:
+            json.dump(record, record_file)
+    return {
+        'stats': stats,
+        'digest': digest,
+        'empty': record is None,
+        'categories': categories,
+        'labware': labware_refs,
+        'index': get_index_entry(record) if record is not None else None}
 
 
 def merge_protocols(path):
-    # Create generator object of protocol object(s) found
-    # in the /protocols directory
-    protocols = []
+    # Stream a record for each protocol found in the builds dir
+    # straight into the output JSON and its zip entry.
+    # Returns the path of the zip file.
+    os.makedirs(MERGE_CACHE_DIR, exist_ok=True)
+    manifest = load_manifest()
+    updated_manifest = {}
     categories = defaultdict(set)
-    for build_dir in search_directory(path, None):
-        root = build_dir['root']
-        # Inside a given protocol directory from the releases/builds dir
-        # Metadata blob
-        with open(os.path.join(root, 'metadata.json'), 'r') as meta:
-            metadata = json.load(meta)
-            status = metadata['status']
-            file_order = metadata['files']
-
-        # README Blob
-        with open(os.path.join(root, 'README.json'), 'r') as md:
-            md_data = json.load(md)
-            add_categories(md_data, metadata, categories, root)
-
-        # Protocol blob
-        metadata['protocols'] = {'OT 1 protocol': [], 'OT 2 protocol': []}
-
-        for ot1 in file_order['OT 1 protocol']:
-            with open(os.path.join(root, '{}.json'.format(ot1)), 'r') as proto:
-                proto_data = json.load(proto)
-            metadata['protocols']['OT 1 protocol'].append(proto_data)
-        for ot2 in file_order['OT 2 protocol']:
-            with open(os.path.join(root, '{}.json'.format(ot2)), 'r') as proto:
-                proto_data = json.load(proto)
-            metadata['protocols']['OT 2 protocol'].append(proto_data)
-
-        if status != 'empty':
-            for key, value in md_data.items():
-                metadata[key] = value
-            protocols.append(metadata)
-        else:
-            pass
-
-    updated_categories = serialize_set(categories)
-    append_to_output(updated_categories, protocols)
+    released = []
+    labware_refs = set()
+    with open_release() as (final_file, zf):
+        with zf.open('output.json', 'w') as zipped_file:
+            output = OutputStream(final_file, zipped_file)
+            output.write('{"protocols": [')
+            separator = ''
+            for build_dir in search_directory(path, None):
+                root = build_dir['root']
+                if store.is_store_dir(root):
+                    continue
+                entry = update_entry(manifest.get(root), root)
+                updated_manifest[root] = entry
+                for key, value in entry['categories']:
+                    categories[key].add(value)
+                if entry['empty']:
+                    continue
+                with open(record_path(entry['digest']), 'r') as record_file:
+                    output.write(
+                        separator + resolve_content(record_file.read()))
+                separator = ', '
+                released.append((root, build_dir['files'], entry))
+                labware_refs.update(entry['labware'])
+
+            # every unique custom labware definition, keyed by its digest
+            output.write('], "labware": {')
+            separator = ''
+            for digest in sorted(labware_refs):
+                output.write('{}"{}": {}'.format(
+                    separator, digest,
+                    store.read_blob(store.LABWARE, digest)))
+                separator = ', '
+
+            updated_categories = serialize_set(categories)
+            output.write('}}, "categories": {}}}'.format(
+                json.dumps(updated_categories)))
+
+        # shards are the cached records, not re-serialized
+        for root, file_names, entry in released:
+            slug = entry['index']['slug']
+            with open(record_path(entry['digest']), 'r') as record_file:
+                zf.writestr(
+                    SHARD_NAME.format(slug),
+                    resolve_content(record_file.read()))
+            # deck layouts of every field configuration and consumables
+            # of other sample counts, if swept
+            for name in sorted(file_names):
+                if name.endswith(LAYOUTS_SUFFIX):
+                    zf.write(
+                        os.path.join(root, name),
+                        LAYOUTS_NAME.format(slug, name))
+                elif name.endswith(SAMPLES_SUFFIX):
+                    zf.write(
+                        os.path.join(root, name),
+                        SAMPLES_NAME.format(slug, name))
+        for digest in sorted(labware_refs):
+            zf.write(
+                store.blob_path(store.LABWARE, digest),
+                LABWARE_NAME.format(digest))
+        index = {
+            'categories': updated_categories,
+            'protocols': [entry['index'] for _, _, entry in released]}
+        with open(os.path.join(RELEASES_DIR, INDEX_NAME), 'w') as index_file:
+            json.dump(index, index_file)
+        zf.write(os.path.join(RELEASES_DIR, INDEX_NAME), INDEX_NAME)
+        zip_path = zf.filename
+    save_manifest(updated_manifest)
+    return zip_path
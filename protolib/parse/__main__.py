@@ -0,0 +1,5 @@
+import sys
+
+from protolib.parse import batch
+
+sys.exit(batch.main())
@@ -0,0 +1,163 @@
+"""
+Batch mode for the OT2 APIv2 parser.
+
+Launching `parseOT2v2.py` once per protocol pays for activating the venv,
+importing opentrons and building a simulating hardware controller every
+time, which dominates the wall time of short protocols. Here a pool of
+long-lived workers does that setup once each, then pulls protocol paths
+off the pool's task queue, resetting the shared hardware between
+protocols. Builds whose content-hash key is unchanged are skipped.
+
+    python -m protolib.parse [-j JOBS] [--force] [--profile] [--commands] \
+        [PROTOCOL ...]
+"""
+import argparse
+import multiprocessing
+import os
+import signal
+import traceback
+
+from protolib.parse import cache, commands, profiling
+from protolib.traversals import find_ot2_protocols, ot2_build_path
+
+# per-worker state, set up once by `_init_worker`
+_parser = None
+_hardware = None
+
+
+def _init_worker():
+    global _parser
+    global _hardware
+    # imported here so that only the workers pay for importing opentrons
+    from protolib.parse import parseOT2v2
+    _parser = parseOT2v2
+    _hardware = parseOT2v2.build_hardware()
+
+
+class SimulationTimeout(BaseException):
+    # not an Exception, so that the `except Exception` of protocols, of
+    # the command recorder and of opentrons don't swallow or wrap it
+    pass
+
+
+class TimeLimit(object):
+    """
+    Raises `SimulationTimeout` in the block it guards after :param:seconds,
+    then every second until the block ends, in case something caught it.
+    `expired` tells whether it went off, whatever the block raised.
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expired = False
+
+    def _expire(self, signum, frame):
+        self.expired = True
+        raise SimulationTimeout()
+
+    def __enter__(self):
+        self.handler = signal.signal(signal.SIGALRM, self._expire)
+        signal.setitimer(signal.ITIMER_REAL, self.seconds, 1.0)
+        return self
+
+    def __exit__(self, *exc_info):
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, self.handler)
+        return False
+
+
+def _parse_one(job):
+    protocol_path, dest_path, build_key, profile, record = job
+    profile = profiling.SimulationProfile() if profile else None
+    recorder = commands.CommandRecorder() if record else None
+    try:
+        _parser.reset_hardware(_hardware)
+        result = _parser.parse(
+            str(protocol_path), hardware=_hardware, profile=profile,
+            recorder=recorder)
+        os.makedirs(str(dest_path.parent), exist_ok=True)
+        _parser.write_build(result, str(dest_path))
+        cache.write_key(dest_path, build_key)
+        if profile is not None:
+            profiling.write_profile(profile, dest_path)
+        if recorder is not None:
+            commands.write_commands(recorder.stream, dest_path)
+            cache.write_key(commands.commands_path(dest_path), build_key)
+    except Exception:
+        return protocol_path, traceback.format_exc()
+    return protocol_path, None
+
+
+def get_jobs(protocol_paths, force=False, profile=False, record=False):
+    """
+    Returns (protocol path, build path, build key, profile, record) for
+    each protocol that needs to be simulated. Profiling always simulates,
+    recording only when the build or its command stream is stale.
+    """
+    opentrons_version = cache.get_opentrons_version()
+    jobs = []
+    for protocol_path in protocol_paths:
+        dest_path = ot2_build_path(protocol_path)
+        build_key = cache.protocol_key(protocol_path, opentrons_version)
+        if force or profile or not cache.is_fresh(dest_path, build_key) or (
+                record and not cache.is_fresh(
+                    commands.commands_path(dest_path), build_key)):
+            jobs.append(
+                (protocol_path, dest_path, build_key, profile, record))
+    return jobs
+
+
+def run_batch(jobs, processes=None):
+    """
+    Simulates every job on a pool of :param:processes workers.
+    Returns a list of (protocol path, traceback) for failed protocols.
+    """
+    failures = []
+    if not jobs:
+        return failures
+    processes = min(processes or os.cpu_count() or 1, len(jobs))
+    with multiprocessing.Pool(processes, initializer=_init_worker) as pool:
+        results = pool.imap_unordered(_parse_one, jobs)
+        for i, (protocol_path, error) in enumerate(results, 1):
+            print('[{}/{}] {} {}'.format(
+                i, len(jobs), 'FAILED' if error else 'parsed',
+                protocol_path))
+            if error:
+                failures.append((protocol_path, error))
+    return failures
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(
+        prog='python -m protolib.parse',
+        description='Simulate OT2 APIv2 protocols into protoBuilds.')
+    arg_parser.add_argument(
+        'protocols', nargs='*',
+        help='protocol files to parse (default: every OT2 APIv2 protocol)')
+    arg_parser.add_argument(
+        '-j', '--jobs', type=int, default=None,
+        help='number of worker processes (default: number of CPUs)')
+    arg_parser.add_argument(
+        '--force', action='store_true',
+        help='re-simulate protocols even if their build is up to date')
+    arg_parser.add_argument(
+        '--profile', action='store_true',
+        help='simulate every protocol with cProfile and save a '
+             '.profile.json next to its build (see protolib.parse.profiling)')
+    arg_parser.add_argument(
+        '--commands', action='store_true',
+        help='save the simulated command stream next to each build '
+             '(see protolib.parse.commands)')
+    args = arg_parser.parse_args(argv)
+
+    protocol_paths = args.protocols or list(find_ot2_protocols())
+    jobs = get_jobs(
+        protocol_paths, force=args.force, profile=args.profile,
+        record=args.commands)
+    print('OT2 APIv2: {} of {} protocols need parsing'.format(
+        len(jobs), len(protocol_paths)))
+
+    failures = run_batch(jobs, args.jobs)
+    for protocol_path, error in failures:
+        print('***** FAILED TO PARSE {} *****\n{}'.format(
+            protocol_path, error))
+    return 1 if failures else 0
@@ -0,0 +1,143 @@
+"""
+Content-addressed build cache for OT2 APIv2 protocol simulation.
+
+Make decides what to rebuild from file timestamps, which git does not
+preserve, so every fresh checkout used to re-simulate every protocol.
+Instead, each build JSON gets a `.key` file next to it holding a hash of
+everything that can change the simulation result: the protocol source,
+its `fields.json`, every file under its `labware/` dir, the otcustomizers
+helpers it inlines (see `protolib/bundle.py`) and the installed
+opentrons version (plus the version of the build format itself). A build
+is fresh when the stored key matches.
+
+This module deliberately does not import opentrons, so checking freshness
+stays cheap:
+
+    python -m protolib.parse.cache SOURCE DEST   # exit 0 if DEST is fresh
+    python -m protolib.parse.cache --check       # list all stale builds
+"""
+import hashlib
+import sys
+from pathlib import Path
+
+from protolib import bundle
+from protolib.traversals import find_ot2_protocols, ot2_build_path
+
+KEY_SUFFIX = '.key'
+# bump whenever parseOT2v2 changes what it writes, to invalidate old builds
+BUILD_FORMAT = 7
+
+
+def get_opentrons_version():
+    """
+    Returns the installed opentrons version without importing opentrons.
+    """
+    try:
+        from importlib.metadata import version
+    except ImportError:  # python < 3.8
+        from pkg_resources import get_distribution
+        return get_distribution('opentrons').version
+    return version('opentrons')
+
+
+def _update(digest, name, data):
+    # length-prefix every field so that adjacent inputs can't run together
+    for field in (name.encode('utf-8'), data):
+        digest.update(str(len(field)).encode('ascii') + b':')
+        digest.update(field)
+
+
+def protocol_inputs(protocol_path):
+    """
+    Returns a sorted list of (name, path) pairs for every file that
+    the simulation of :param:protocol_path reads.
+    """
+    protocol_path = Path(protocol_path)
+    protocol_dir = protocol_path.parent
+    inputs = [(protocol_path.name, protocol_path)]
+
+    fields_json_path = protocol_dir / 'fields.json'
+    if fields_json_path.is_file():
+        inputs.append(('fields.json', fields_json_path))
+
+    labware_dir = protocol_dir / 'labware'
+    if labware_dir.is_dir():
+        inputs += sorted(
+            (str(path.relative_to(protocol_dir)), path)
+            for path in labware_dir.rglob('*') if path.is_file())
+
+    # helpers inlined into the protocol by protolib.bundle
+    inputs += [
+        (module, Path(bundle.helper_path(module)))
+        for module in bundle.helper_modules(protocol_path.read_text())]
+
+    return inputs
+
+
+def protocol_key(protocol_path, opentrons_version):
+    """
+    Returns the hex digest identifying a simulation of :param:protocol_path
+    under opentrons :param:opentrons_version.
+    """
+    digest = hashlib.sha256()
+    for name, path in protocol_inputs(protocol_path):
+        _update(digest, name, path.read_bytes())
+    _update(digest, 'opentrons', str(opentrons_version).encode('utf-8'))
+    _update(digest, 'format', str(BUILD_FORMAT).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def files_key(paths):
+    """
+    Returns the hex digest of the names and contents of :param:paths.
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        path = Path(path)
+        _update(digest, path.name, path.read_bytes())
+    return digest.hexdigest()
+
+
+def key_path(dest_path):
+    return Path('{}{}'.format(dest_path, KEY_SUFFIX))
+
+
+def read_key(dest_path):
+    try:
+        return key_path(dest_path).read_text().strip()
+    except FileNotFoundError:
+        return None
+
+
+def write_key(dest_path, key):
+    key_path(dest_path).write_text(key + '\n')
+
+
+def is_fresh(dest_path, key):
+    return Path(dest_path).is_file() and read_key(dest_path) == key
+
+
+def find_stale(opentrons_version):
+    """
+    Yields (protocol path, build path) for every OT2 APIv2 protocol whose
+    build JSON is missing or was built from different inputs.
+    """
+    for protocol_path in find_ot2_protocols():
+        dest_path = ot2_build_path(protocol_path)
+        if not is_fresh(
+                dest_path, protocol_key(protocol_path, opentrons_version)):
+            yield protocol_path, dest_path
+
+
+if __name__ == '__main__':
+    version = get_opentrons_version()
+    if sys.argv[1:] == ['--check']:
+        stale = list(find_stale(version))
+        for protocol_path, dest_path in stale:
+            print('{} -> {}'.format(protocol_path, dest_path))
+        sys.exit(1 if stale else 0)
+
+    sourceFilePath, destFilePath = sys.argv[1:3]
+    sys.exit(
+        0 if is_fresh(destFilePath, protocol_key(sourceFilePath, version))
+        else 1)
@@ -0,0 +1,321 @@
+"""
+Compact, columnar record of the commands a protocol simulation executed.
+
+`CommandRecorder` subscribes to the simulation's command broker and stores
+one row per command in typed `array` columns:
+
+    kind         B  index into the `kind` table ('aspirate', 'delay'...)
+    depth        B  nesting level (transfer > aspirate is depth 1)
+    pipette      b  index into the `pipette` table ('left:p300_single'), or -1
+    volume       f  uL
+    flow_rate    f  uL/s, for aspirate, dispense and blow out
+    slot         b  deck slot of the target location, or -1
+    location     h  index into the `location` table ('1:A1'), or -1
+    x, y, z      f  deck coordinates of the target location
+    seconds      f  delay and hold durations
+    temperature  f  module target temperatures
+    label        h  index into the `label` table (comment and pause text),
+                    or -1
+
+Missing numbers are NaN. `python -m protolib.parse --commands` saves each
+stream next to its build as `<name>.ot2.apiv2.py.commands.bin`: a magic
+line, the length and JSON of a header with the tables, then every column's
+little-endian bytes.
+
+    python -m protolib.parse.commands [BUILD_DIR]
+
+prints totals over every saved stream, without simulating anything.
+"""
+import json
+import math
+import re
+import struct
+import sys
+from array import array
+from collections import Counter
+from pathlib import Path
+
+from protolib.traversals import PROTOCOLS_BUILD_DIR
+
+COMMANDS_SUFFIX = '.commands.bin'
+MAGIC = b'PLCMD1\n'
+COLUMNS = [
+    ('kind', 'B'),
+    ('depth', 'B'),
+    ('pipette', 'b'),
+    ('volume', 'f'),
+    ('flow_rate', 'f'),
+    ('slot', 'b'),
+    ('location', 'h'),
+    ('x', 'f'),
+    ('y', 'f'),
+    ('z', 'f'),
+    ('seconds', 'f'),
+    ('temperature', 'f'),
+    ('label', 'h'),
+]
+# largest index the signed table columns can hold; values interned past
+# it are recorded as -1 (unknown), like slots that don't fit their column
+MAX_INDEX = {'pipette': 127, 'location': 32767, 'label': 32767}
+# longest comment or pause text kept as a label
+MAX_LABEL = 80
+NAN = float('nan')
+# commands that only group the commands nested in them
+CONTAINERS = {'transfer', 'distribute', 'consolidate', 'mix'}
+
+
+# thermocycler payloads only carry these in their text
+REPETITIONS = re.compile(r'starting (\d+) repetitions')
+LID_TEMPERATURE = re.compile(r'lid temperature to (-?\d+(\.\d+)?)')
+
+
+def hold_seconds(payload, prefix=''):
+    seconds = payload.get(prefix + 'seconds') or 0
+    minutes = payload.get(prefix + 'minutes') or 0
+    return float(seconds) + 60 * float(minutes)
+
+
+def profile_seconds(payload):
+    """
+    Returns the hold time of a thermocycler profile, whose payload has its
+    steps and says how many times they repeat in its text.
+    """
+    steps = payload.get('steps') or []
+    cycle = sum(hold_seconds(step, 'hold_time_') for step in steps)
+    repetitions = REPETITIONS.search(str(payload.get('text') or ''))
+    return cycle * (int(repetitions.group(1)) if repetitions else 1)
+
+
+def payload_temperature(kind, payload):
+    if kind == 'thermocycler_set_lid_temp':
+        # the lid command only has the temperature in its text
+        match = LID_TEMPERATURE.search(str(payload.get('text') or ''))
+        return float(match.group(1)) if match else None
+    return payload.get('celsius', payload.get('temperature'))
+
+
+def target_parts(location):
+    """
+    Returns the (slot, well name, point) of a command location, which may
+    be a `Location`, a `Well`, a `Labware` or a slot name.
+    """
+    point = None
+    target = location
+    if hasattr(location, 'point') and hasattr(location, 'labware'):
+        point = location.point
+        target = location.labware
+    # `Location.labware` is wrapped in a `LabwareLike`
+    if hasattr(target, 'object') and hasattr(target, 'first_parent'):
+        target = target.object
+    well = None
+    if hasattr(target, 'top') and hasattr(target, 'parent') and \
+            type(target).__name__ == 'Well':
+        well = target
+        if point is None:
+            point = well.top().point
+        target = well.parent
+    slot = target
+    for _ in range(4):
+        if slot is None or isinstance(slot, (str, int)):
+            break
+        slot = getattr(slot, 'parent', None)
+    well_name = None
+    if well is not None:
+        well_name = getattr(well, 'well_name', None) or \
+            str(well).split(' of ', 1)[0]
+    try:
+        slot = int(slot)
+    except (TypeError, ValueError):
+        slot = -1
+    return slot, well_name, point
+
+
+class CommandStream(object):
+    """
+    Typed columns of a command stream and the tables their indexes
+    refer to.
+    """
+    def __init__(self, columns=None, tables=None):
+        self.columns = columns or {
+            name: array(typecode) for name, typecode in COLUMNS}
+        self.tables = tables or {
+            'kind': [], 'pipette': [], 'location': [], 'label': []}
+
+    def __len__(self):
+        return len(self.columns['kind'])
+
+    def kinds(self):
+        table = self.tables['kind']
+        return [table[i] for i in self.columns['kind']]
+
+    def pipettes(self):
+        table = self.tables['pipette']
+        return [table[i] if i >= 0 else None
+                for i in self.columns['pipette']]
+
+    def locations(self):
+        table = self.tables['location']
+        return [table[i] if i >= 0 else None
+                for i in self.columns['location']]
+
+    def labels(self):
+        table = self.tables['label']
+        return [table[i] if i >= 0 else None
+                for i in self.columns['label']]
+
+
+class CommandRecorder(object):
+    def __init__(self):
+        self.stream = CommandStream()
+        self._indexes = {name: {} for name in self.stream.tables}
+        self._depth = 0
+
+    def table_index(self, table, value):
+        if value is None:
+            return -1
+        indexes = self._indexes[table]
+        if value not in indexes:
+            # kinds are the few opentrons command names, and always fit
+            if table in MAX_INDEX and len(indexes) > MAX_INDEX[table]:
+                return -1
+            indexes[value] = len(self.stream.tables[table])
+            self.stream.tables[table].append(value)
+        return indexes[value]
+
+    def on_command(self, message):
+        if message['$'] == 'after':
+            self._depth = max(0, self._depth - 1)
+            return
+        kind = message['name'].split('.', 1)[-1].lower()
+        try:
+            row = self.row(kind, message.get('payload') or {})
+        except Exception:
+            # never let an unexpected payload break the simulation
+            row = self.row(kind, {})
+        columns = self.stream.columns
+        for name, _ in COLUMNS:
+            columns[name].append(row[name])
+        self._depth += 1
+
+    def row(self, kind, payload):
+        instrument = payload.get('instrument')
+        pipette = None
+        flow_rate = NAN
+        if instrument is not None:
+            pipette = '{}:{}'.format(
+                getattr(instrument, 'mount', ''),
+                getattr(instrument, 'name', ''))
+            flow_rates = getattr(instrument, 'flow_rate', None)
+            if kind in ('aspirate', 'dispense', 'blow_out') and flow_rates:
+                flow_rate = float(getattr(flow_rates, kind)) * float(
+                    payload.get('rate') or 1)
+
+        slot, well_name, point = -1, None, None
+        if payload.get('location') is not None:
+            slot, well_name, point = target_parts(payload['location'])
+
+        seconds = NAN
+        if kind == 'delay':
+            seconds = hold_seconds(payload)
+        elif kind == 'thermocycler_set_block_temp':
+            # the total of hold_time_seconds and hold_time_minutes
+            seconds = float(payload.get('hold_time') or 0)
+        elif kind == 'thermocycler_execute_profile':
+            seconds = profile_seconds(payload)
+        temperature = payload_temperature(kind, payload)
+        volume = payload.get('volume')
+        label = None
+        if kind in ('comment', 'pause'):
+            label = str(
+                payload.get('userMessage') or payload.get('text') or '')
+            label = label.strip()[:MAX_LABEL] or None
+
+        return {
+            'kind': self.table_index('kind', kind),
+            'depth': min(self._depth, 255),
+            'pipette': self.table_index('pipette', pipette),
+            'volume': float(volume) if volume is not None else NAN,
+            'flow_rate': flow_rate,
+            'slot': slot if -128 < slot < 128 else -1,
+            'location': self.table_index(
+                'location',
+                '{}:{}'.format(slot, well_name) if well_name else None),
+            'x': float(point.x) if point is not None else NAN,
+            'y': float(point.y) if point is not None else NAN,
+            'z': float(point.z) if point is not None else NAN,
+            'seconds': seconds,
+            'temperature': (
+                float(temperature) if temperature is not None else NAN),
+            'label': self.table_index('label', label)
+        }
+
+
+def commands_path(dest_path):
+    return Path('{}{}'.format(dest_path, COMMANDS_SUFFIX))
+
+
+def write_commands(stream, dest_path):
+    header = json.dumps({
+        'count': len(stream),
+        'columns': COLUMNS,
+        'tables': stream.tables
+    }, separators=(',', ':')).encode('utf-8')
+    with open(commands_path(dest_path), 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        for name, _ in COLUMNS:
+            column = stream.columns[name]
+            if sys.byteorder == 'big':
+                column = array(column.typecode, column)
+                column.byteswap()
+            f.write(column.tobytes())
+
+
+def read_commands(path):
+    """
+    Returns the `CommandStream` saved at :param:path.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a command stream'.format(path))
+        header_length, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(header_length).decode('utf-8'))
+        columns = {}
+        for name, typecode in header['columns']:
+            column = array(typecode)
+            column.frombytes(f.read(column.itemsize * header['count']))
+            if sys.byteorder == 'big':
+                column.byteswap()
+            columns[name] = column
+    return CommandStream(columns, header['tables'])
+
+
+def find_streams(build_dir=PROTOCOLS_BUILD_DIR):
+    return sorted(Path(build_dir).rglob('*' + COMMANDS_SUFFIX))
+
+
+def print_totals(build_dir=PROTOCOLS_BUILD_DIR):
+    kinds = Counter()
+    volume = 0.0
+    seconds = 0.0
+    paths = find_streams(build_dir)
+    for path in paths:
+        stream = read_commands(path)
+        stream_kinds = stream.kinds()
+        kinds.update(stream_kinds)
+        volume += math.fsum(
+            v for v, k in zip(stream.columns['volume'], stream_kinds)
+            if k == 'aspirate' and not math.isnan(v))
+        seconds += math.fsum(
+            s for s in stream.columns['seconds'] if not math.isnan(s))
+    print('{} command streams, {} commands'.format(
+        len(paths), sum(kinds.values())))
+    print('{:.1f} mL aspirated, {:.1f} h of delays and holds'.format(
+        volume / 1000, seconds / 3600))
+    for kind, count in kinds.most_common():
+        print('{:>10}  {}'.format(count, kind))
+
+
+if __name__ == '__main__':
+    print_totals(*sys.argv[1:2])
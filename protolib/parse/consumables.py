@@ -0,0 +1,130 @@
+"""
+Consumables a protocol run uses, counted from its simulated command stream.
+
+    {
+        "tips": {"opentrons_96_tiprack_300ul":
+                 {"pickups": 24, "tips": 192, "racks": 2}},
+        "sources": {"1": {"type": "nest_12_reservoir_15ml",
+                          "wells": {"A1": 9600.0, "A2": 4800.0}}},
+        "aspirated": 14400.0,
+        "waste": 12000.0
+    }
+
+Multichannel pipettes use 8 tips per pickup and aspirate their volume
+8 times, which is counted against the well they are aimed at (the top
+well of the column). `racks` is the number of racks of each type the run
+goes through, counting a rack again every time its tips are picked up
+again after a refill or `reset_tipracks`. `sources` is the volume
+aspirated from every well, by slot, and `waste` the volume dispensed
+into the trash or into labware labelled as waste.
+
+The build JSON has the consumables of the default configuration in
+`consumables`. Those of other sample counts are swept separately, see
+`protolib.parse.samples`.
+"""
+import math
+import re
+from collections import Counter, defaultdict
+
+# num_samples, sample_count, number_of_samples, numSamps, samp_no...
+SAMPLE_FIELD = re.compile(
+    r'^(num|number|total|no)?_?(of_)?samp(le)?s?'
+    r'(_(count|number|no|to_process))?$', re.IGNORECASE)
+# of the default, for int fields without a `min` and `max`
+SAMPLE_FRACTIONS = [0.25, 0.5]
+TRASH_SLOT = 12
+MULTI_CHANNELS = 8
+
+
+def sample_field(fields):
+    """
+    Returns the field of :param:fields that sets the number of samples.
+    """
+    for field in fields:
+        if field['type'] in ('int', 'dropDown') and \
+                SAMPLE_FIELD.match(field['name']):
+            return field
+    return None
+
+
+def sample_counts(field):
+    """
+    Returns the sample counts to simulate besides the default one: the
+    other options of a dropDown, or the `min`, the `max` and fractions of
+    the default of an int field. The default is usually the most samples
+    the deck holds, so it is the `max` unless the field sets one.
+    """
+    if field['type'] == 'dropDown':
+        default = field['options'][0]['value']
+        return [option['value'] for option in field['options']
+                if option['value'] != default]
+    default = field.get('default')
+    if not isinstance(default, int) or isinstance(default, bool) or \
+            default < 1:
+        return []
+    low, high = field.get('min', 1), field.get('max', default)
+    counts = {low, high} | {
+        int(round(default * fraction)) for fraction in SAMPLE_FRACTIONS}
+    return sorted(
+        count for count in counts if low <= count <= high and count != default)
+
+
+def is_waste(slot, labware):
+    if slot == TRASH_SLOT:
+        return True
+    return 'waste' in labware.get('name', '').lower()
+
+
+def channels(pipette):
+    return MULTI_CHANNELS if pipette and 'multi' in pipette else 1
+
+
+def count_consumables(stream, labware):
+    """
+    Returns the consumables of a `commands.CommandStream`, given the
+    `labware` list of its build.
+    """
+    labware_by_slot = {int(lw['slot']): lw for lw in labware
+                       if str(lw['slot']).isdigit()}
+    columns = stream.columns
+    kinds = stream.kinds()
+    locations = stream.locations()
+    pipettes = stream.pipettes()
+
+    pickups = defaultdict(Counter)
+    tip_counts = Counter()
+    sources = defaultdict(lambda: defaultdict(float))
+    aspirated = 0.0
+    waste = 0.0
+    for i, kind in enumerate(kinds):
+        slot = columns['slot'][i]
+        volume = columns['volume'][i] * channels(pipettes[i])
+        if kind == 'pick_up_tip' and locations[i] is not None:
+            pickups[slot][locations[i]] += 1
+            tip_counts[slot] += channels(pipettes[i])
+        elif kind == 'aspirate' and not math.isnan(volume):
+            aspirated += volume
+            if locations[i] is not None:
+                sources[slot][locations[i].split(':', 1)[1]] += volume
+        elif kind == 'dispense' and not math.isnan(volume) and is_waste(
+                slot, labware_by_slot.get(slot, {})):
+            waste += volume
+
+    tips = defaultdict(lambda: {'pickups': 0, 'tips': 0, 'racks': 0})
+    for slot, wells in sorted(pickups.items()):
+        rack_type = labware_by_slot.get(slot, {}).get('type', 'unknown')
+        tips[rack_type]['pickups'] += sum(wells.values())
+        tips[rack_type]['tips'] += tip_counts[slot]
+        tips[rack_type]['racks'] += max(wells.values())
+    return {
+        'tips': dict(tips),
+        'sources': {
+            str(slot): {
+                'type': labware_by_slot.get(slot, {}).get('type', 'unknown'),
+                'wells': {
+                    well: round(volume, 2)
+                    for well, volume in sorted(wells.items())}}
+            for slot, wells in sorted(sources.items())},
+        'aspirated': round(aspirated, 2),
+        'waste': round(waste, 2)
+    }
@@ -0,0 +1,242 @@
+"""
+Differential simulation of OT2 APIv2 protocols under two opentrons
+installations, to see what an opentrons upgrade changes.
+
+    python -m protolib.parse.differential compare \
+        --base venvs/ot2/bin/python --new venvs/ot2-next/bin/python \
+        [--base-settings DIR] [--new-settings DIR] \
+        [-j JOBS] [-o changes.json] [PROTOCOL ...]
+
+runs `dump` with each interpreter at the same time, with
+`OVERRIDE_SETTINGS_DIR` set to the settings dir of its opentrons clone.
+`dump` simulates the protocols on its own worker pool (see
+`protolib.parse.batch`) and writes one JSON line per protocol with its
+loaded instruments, labware and modules and its normalized command
+stream: the kind, pipette, volume, target well and coordinates (to 0.1 mm)
+of every command. Only protocols whose results differ are reported, with
+the first command where they diverge and how the number of commands of
+each kind changed.
+
+This module does not import opentrons, so it runs from any python.
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import traceback
+from collections import Counter
+
+from protolib.parse import batch, commands
+from protolib.traversals import find_ot2_protocols
+
+
+def normalize_stream(stream):
+    columns = stream.columns
+
+    def rounded(value, digits):
+        return None if math.isnan(value) else round(value, digits)
+
+    return [
+        [kind, pipette, rounded(columns['volume'][i], 2), location,
+         rounded(columns['x'][i], 1), rounded(columns['y'][i], 1),
+         rounded(columns['z'][i], 1)]
+        for i, (kind, pipette, location) in enumerate(zip(
+            stream.kinds(), stream.pipettes(), stream.locations()))]
+
+
+def _dump_one(protocol_path):
+    recorder = commands.CommandRecorder()
+    try:
+        batch._parser.reset_hardware(batch._hardware)
+        result = batch._parser.parse(
+            str(protocol_path), hardware=batch._hardware, recorder=recorder)
+    except Exception:
+        return str(protocol_path), {
+            'error': traceback.format_exc().strip().splitlines()[-1]}
+    return str(protocol_path), {
+        'instruments': result['instruments'],
+        'labware': result['labware'],
+        'modules': result['modules'],
+        'commands': normalize_stream(recorder.stream)}
+
+
+def dump(protocol_paths, output, processes=None):
+    processes = min(processes or os.cpu_count() or 1, len(protocol_paths))
+    with multiprocessing.Pool(
+            processes, initializer=batch._init_worker) as pool, \
+            open(output, 'w') as f:
+        for protocol_path, result in pool.imap_unordered(
+                _dump_one, protocol_paths):
+            f.write(json.dumps(
+                {'protocol': protocol_path, 'result': result},
+                sort_keys=True) + '\n')
+
+
+def read_dump(path):
+    with open(path) as f:
+        return {
+            entry['protocol']: entry['result']
+            for entry in map(json.loads, f)}
+
+
+def diff_results(base, new):
+    """
+    Returns what changed between two results of one protocol,
+    or None if nothing did.
+    """
+    if base == new:
+        return None
+    if 'error' in base or 'error' in new:
+        # a failed simulation has nothing else to compare
+        return {'error': [base.get('error'), new.get('error')]}
+    changes = {}
+    for key in ('instruments', 'labware', 'modules'):
+        if base.get(key) != new.get(key):
+            changes[key] = [base.get(key), new.get(key)]
+    base_commands = base.get('commands', [])
+    new_commands = new.get('commands', [])
+    if base_commands != new_commands:
+        first = next(
+            (i for i, (a, b) in enumerate(zip(base_commands, new_commands))
+             if a != b), min(len(base_commands), len(new_commands)))
+        base_kinds = Counter(command[0] for command in base_commands)
+        new_kinds = Counter(command[0] for command in new_commands)
+        changes['commands'] = {
+            'count': [len(base_commands), len(new_commands)],
+            'first_difference': first,
+            'at': [
+                base_commands[first] if first < len(base_commands) else None,
+                new_commands[first] if first < len(new_commands) else None],
+            'kinds': {
+                kind: new_kinds[kind] - base_kinds[kind]
+                for kind in sorted(set(base_kinds) | set(new_kinds))
+                if new_kinds[kind] != base_kinds[kind]}}
+    return changes
+
+
+def run_dumps(pythons, protocol_paths, directory, processes=None):
+    """
+    Dumps :param:protocol_paths with every (name, python, settings dir)
+    of :param:pythons at the same time. Returns the paths of the dumps.
+    """
+    # each side gets half the CPUs, so the two runs don't compete
+    processes = processes or max(1, (os.cpu_count() or 2) // 2)
+    outputs = []
+    runs = []
+    for name, python, settings in pythons:
+        output = os.path.join(directory, '{}.jsonl'.format(name))
+        outputs.append(output)
+        env = dict(os.environ)
+        if settings:
+            env['OVERRIDE_SETTINGS_DIR'] = settings
+        runs.append(subprocess.Popen(
+            [python, '-m', 'protolib.parse.differential', 'dump',
+             '-j', str(processes), '-o', output] +
+            [str(path) for path in protocol_paths],
+            stdout=subprocess.DEVNULL, env=env))
+    for (name, python, _), run in zip(pythons, runs):
+        if run.wait() != 0:
+            raise SystemExit('dumping with {} ({}) failed'.format(
+                name, python))
+    return outputs
+
+
+def compare(base, new, protocol_paths, processes=None):
+    """
+    Returns the changes of every protocol whose results differ between the
+    (python, settings dir) pairs :param:base and :param:new.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        base_path, new_path = run_dumps(
+            [('base',) + tuple(base), ('new',) + tuple(new)],
+            protocol_paths, directory, processes)
+        base, new = read_dump(base_path), read_dump(new_path)
+    changes = {}
+    for protocol_path in sorted(set(base) | set(new)):
+        change = diff_results(
+            base.get(protocol_path, {'error': 'missing'}),
+            new.get(protocol_path, {'error': 'missing'}))
+        if change:
+            changes[protocol_path] = change
+    return changes
+
+
+def print_changes(changes, total):
+    print('{} of {} protocols changed'.format(len(changes), total))
+    for protocol_path, change in sorted(changes.items()):
+        print('\n{}'.format(protocol_path))
+        if 'error' in change:
+            print('  error: {} -> {}'.format(*change['error']))
+        for key in ('instruments', 'labware', 'modules'):
+            if key in change:
+                print('  {} changed'.format(key))
+        if 'commands' in change:
+            command_change = change['commands']
+            print('  {} -> {} commands, first difference at #{}'.format(
+                command_change['count'][0], command_change['count'][1],
+                command_change['first_difference']))
+            print('    base: {}\n    new:  {}'.format(*command_change['at']))
+            if command_change['kinds']:
+                print('    {}'.format(', '.join(
+                    '{} {:+d}'.format(kind, delta)
+                    for kind, delta in command_change['kinds'].items())))
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(
+        prog='python -m protolib.parse.differential',
+        description='Compare protocol simulations under two opentrons '
+                    'installations.')
+    commands_parser = arg_parser.add_subparsers(dest='command')
+
+    compare_parser = commands_parser.add_parser(
+        'compare', help='simulate with two interpreters, report changes')
+    compare_parser.add_argument(
+        '--base', required=True, help='python of the current opentrons')
+    compare_parser.add_argument(
+        '--new', required=True, help='python of the opentrons to compare')
+    compare_parser.add_argument(
+        '--base-settings', help='OVERRIDE_SETTINGS_DIR for --base')
+    compare_parser.add_argument(
+        '--new-settings', help='OVERRIDE_SETTINGS_DIR for --new')
+    compare_parser.add_argument(
+        '-o', '--output', help='also write the changes as JSON here')
+
+    dump_parser = commands_parser.add_parser(
+        'dump', help='simulate with this interpreter into a JSON lines file')
+    dump_parser.add_argument('-o', '--output', required=True)
+
+    for parser in (compare_parser, dump_parser):
+        parser.add_argument(
+            'protocols', nargs='*',
+            help='protocol files (default: every OT2 APIv2 protocol)')
+        parser.add_argument(
+            '-j', '--jobs', type=int, default=None,
+            help='worker processes per interpreter')
+    args = arg_parser.parse_args(argv)
+    if args.command is None:
+        arg_parser.print_help()
+        return 2
+
+    protocol_paths = args.protocols or [
+        str(path) for path in find_ot2_protocols()]
+    if args.command == 'dump':
+        dump(protocol_paths, args.output, args.jobs)
+        return 0
+
+    changes = compare(
+        (args.base, args.base_settings), (args.new, args.new_settings),
+        protocol_paths, args.jobs)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(changes, f, indent=4, sort_keys=True)
+    print_changes(changes, len(protocol_paths))
+    return 1 if changes else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,287 @@
+"""
+Fuzz OT2 APIv2 protocols over the values their `fields.json` allows.
+
+The default build only ever simulates the default values, so protocols
+that fail for some inputs (sample counts that are not a multiple of 8,
+volumes that overflow a reservoir...) go unnoticed. Here each protocol is
+simulated `--runs` times with values sampled from its fields: any
+`dropDown` option, `int` and `float` values between the `min` and `max` of
+the field, by default between 1 (or 0) and the default, which is usually
+the most the protocol handles, and the default text of `str` and
+`textFile` fields. Runs are spread over
+a pool of workers (the same as `python -m protolib.parse`) and stopped
+after `--timeout` seconds.
+
+Failures are grouped by their error message, with numbers masked. Each
+group but timeouts is shrunk to a smallest reproducing input: fields are
+reset to their defaults one by one, then numbers are moved towards their
+default, for as long as the same error still happens.
+
+    python -m protolib.parse.fuzz [-j JOBS] [--runs 20] [--seed 0] \
+        [--timeout 60] [-o report.json] [PROTOCOL ...]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import re
+import sys
+import traceback
+from collections import OrderedDict
+
+from protolib.parse import batch
+from protolib.parse.layouts import read_fields
+from protolib.traversals import find_ot2_protocols
+
+RUNS = 20
+TIMEOUT = 60
+# simulations a failure may use to shrink its input
+SHRINK_BUDGET = 30
+NUMBER = re.compile(r'\d+(\.\d+)?')
+TIMEOUT_ERROR = 'SimulationTimeout: took more than {}s'
+
+
+def default_values(fields):
+    return OrderedDict(
+        (field['name'], field['options'][0]['value']
+         if field['type'] == 'dropDown' else field.get('default'))
+        for field in fields)
+
+
+def sample_value(field, rng):
+    """
+    Returns a random value of :param:field.
+    """
+    if field['type'] == 'dropDown':
+        return rng.choice(field['options'])['value']
+    default = field.get('default')
+    if field['type'] == 'int' and isinstance(default, int):
+        low = field.get('min', min(default, 1))
+        high = field.get('max', max(default, low))
+        # multiples of 8 fill whole columns, and one off them don't
+        column = high // 8 * 8
+        edges = [low, high, default - 1, 7, 8, 9, column - 1, column + 1]
+        edges = [edge for edge in edges if low <= edge <= high]
+        if edges and rng.random() < 0.5:
+            return rng.choice(edges)
+        return rng.randint(low, high)
+    if field['type'] == 'float' and isinstance(default, (int, float)):
+        low = field.get('min', 0)
+        high = field.get('max', default if default > low else low + 10)
+        return round(rng.uniform(low, high), 1)
+    return default
+
+
+def signature(error):
+    # the same failure with other numbers in its message
+    return NUMBER.sub('#', error)
+
+
+def simulate(protocol_path, values, timeout):
+    """
+    Returns the error of one simulation, or None if it passed.
+    """
+    limit = batch.TimeLimit(timeout)
+    error = None
+    try:
+        with limit:
+            batch._parser.reset_hardware(batch._hardware)
+            batch._parser.parse(
+                str(protocol_path), hardware=batch._hardware, values=values)
+    except batch.SimulationTimeout:
+        pass
+    except Exception:
+        error = traceback.format_exc().strip().splitlines()[-1]
+    # opentrons may have wrapped the timeout in an error of the protocol
+    if limit.expired:
+        return TIMEOUT_ERROR.format(timeout)
+    return error
+
+
+def is_timeout(error):
+    return error.startswith(TIMEOUT_ERROR.split(':')[0])
+
+
+def _fuzz_one(job):
+    protocol_path, values, timeout = job
+    return protocol_path, values, simulate(protocol_path, values, timeout)
+
+
+def shrink(protocol_path, fields, values, error, timeout,
+           budget=SHRINK_BUDGET):
+    """
+    Returns the smallest variation of :param:values found within
+    :param:budget simulations that fails like :param:error, and its error.
+    """
+    defaults = default_values(fields)
+    target = signature(error)
+    current = OrderedDict(values)
+
+    def fails(candidate):
+        nonlocal budget, error
+        if budget <= 0:
+            return False
+        budget -= 1
+        candidate_error = simulate(protocol_path, candidate, timeout)
+        if candidate_error and signature(candidate_error) == target:
+            error = candidate_error
+            return True
+        return False
+
+    # reset as many fields as possible to their default
+    for name, default in defaults.items():
+        if current[name] != default and fails({**current, name: default}):
+            current[name] = default
+
+    # then bring numbers as close to their default as possible
+    for name, default in defaults.items():
+        value = current[name]
+        if value == default or isinstance(value, bool) or \
+                not isinstance(value, (int, float)) or \
+                not isinstance(default, (int, float)):
+            continue
+        passing, failing = default, value
+        for _ in range(8):
+            if isinstance(value, int):
+                if abs(failing - passing) <= 1:
+                    break
+                middle = (passing + failing) // 2
+            else:
+                middle = round((passing + failing) / 2, 2)
+            if fails({**current, name: middle}):
+                failing = middle
+            else:
+                passing = middle
+        current[name] = failing
+
+    minimal = OrderedDict(
+        (name, value) for name, value in current.items()
+        if value != defaults[name])
+    return minimal, error
+
+
+def _shrink_one(job):
+    protocol_path, fields, values, error, timeout = job
+    minimal, error = shrink(protocol_path, fields, values, error, timeout)
+    return protocol_path, signature(error), minimal, error
+
+
+def get_jobs(protocol_paths, runs, seed, timeout):
+    jobs = []
+    fields = {}
+    for protocol_path in protocol_paths:
+        fields[protocol_path] = read_fields(protocol_path)
+        if not fields[protocol_path]:
+            continue
+        # a seed per protocol, so results don't depend on the others
+        rng = random.Random('{}:{}'.format(seed, protocol_path))
+        seen = set()
+        for _ in range(runs):
+            values = OrderedDict(
+                (field['name'], sample_value(field, rng))
+                for field in fields[protocol_path])
+            key = json.dumps(values, sort_keys=True)
+            if key not in seen:
+                seen.add(key)
+                jobs.append((protocol_path, values, timeout))
+    return fields, jobs
+
+
+def run_fuzz(fields, jobs, timeout, processes=None):
+    """
+    Runs every job on a pool of :param:processes workers, then shrinks
+    the first failure of every kind. Returns the report.
+    """
+    report = {}
+    failures = OrderedDict()
+    if not jobs:
+        return report
+    processes = min(processes or os.cpu_count() or 1, len(jobs))
+    with multiprocessing.Pool(
+            processes, initializer=batch._init_worker) as pool:
+        for i, (protocol_path, values, error) in enumerate(
+                pool.imap_unordered(_fuzz_one, jobs), 1):
+            print('[{}/{}] {} {}'.format(
+                i, len(jobs), 'FAILED' if error else 'passed',
+                protocol_path))
+            entry = report.setdefault(
+                str(protocol_path), {'runs': 0, 'failures': []})
+            entry['runs'] += 1
+            if error is None:
+                continue
+            key = (protocol_path, signature(error))
+            if key in failures:
+                failures[key]['hits'] += 1
+            else:
+                failures[key] = {
+                    'error': error, 'hits': 1, 'values': values}
+
+        # a slow input takes the whole timeout to reproduce, shrinking it
+        # would spend the budget waiting
+        shrink_jobs = [
+            (protocol_path, fields[protocol_path], failure['values'],
+             failure['error'], timeout)
+            for (protocol_path, _), failure in failures.items()
+            if not is_timeout(failure['error'])]
+        for protocol_path, error_signature, minimal, error in \
+                pool.imap_unordered(_shrink_one, shrink_jobs):
+            failure = failures[(protocol_path, error_signature)]
+            failure['minimal'] = minimal
+            failure['minimal_error'] = error
+
+    for (protocol_path, _), failure in failures.items():
+        report[str(protocol_path)]['failures'].append(failure)
+    return report
+
+
+def print_report(report):
+    failing = {path: entry for path, entry in report.items()
+               if entry['failures']}
+    print('{} of {} fuzzed protocols failed'.format(
+        len(failing), len(report)))
+    for path, entry in sorted(failing.items()):
+        print('\n{} ({} runs)'.format(path, entry['runs']))
+        for failure in entry['failures']:
+            print('  {} ({} runs)'.format(failure['error'], failure['hits']))
+            print('    smallest input: {}'.format(
+                json.dumps(failure.get('minimal', failure['values']))))
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(
+        prog='python -m protolib.parse.fuzz',
+        description='Simulate OT2 APIv2 protocols with random field values.')
+    arg_parser.add_argument(
+        'protocols', nargs='*',
+        help='protocol files to fuzz (default: every OT2 APIv2 protocol)')
+    arg_parser.add_argument(
+        '-j', '--jobs', type=int, default=None,
+        help='number of worker processes (default: number of CPUs)')
+    arg_parser.add_argument(
+        '--runs', type=int, default=RUNS,
+        help='simulations per protocol (default: {})'.format(RUNS))
+    arg_parser.add_argument(
+        '--seed', default='0', help='seed of the sampled values')
+    arg_parser.add_argument(
+        '--timeout', type=float, default=TIMEOUT,
+        help='seconds per simulation (default: {})'.format(TIMEOUT))
+    arg_parser.add_argument(
+        '-o', '--output', help='also write the report as JSON here')
+    args = arg_parser.parse_args(argv)
+
+    protocol_paths = args.protocols or list(find_ot2_protocols())
+    fields, jobs = get_jobs(
+        protocol_paths, args.runs, args.seed, args.timeout)
+    print('OT2 APIv2: fuzzing {} protocols with {} simulations'.format(
+        len({job[0] for job in jobs}), len(jobs)))
+    report = run_fuzz(fields, jobs, args.timeout, args.jobs)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4, sort_keys=True)
+    print_report(report)
+    return 1 if any(entry['failures'] for entry in report.values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
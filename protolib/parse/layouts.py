@@ -0,0 +1,240 @@
+"""
+Deck layouts of OT2 APIv2 protocols for every field configuration.
+
+The build JSON only holds the layout (instruments, labware and modules)
+simulated with the default field values. This sweep simulates each
+protocol again for every combination of its `dropDown` options and of
+representative values of its `int` fields, and saves the distinct layouts
+next to the build as `<name>.ot2.apiv2.py.layouts.json`:
+
+    {
+        "fields": [{"name": "pipette_type", "choices": ["p300_single", ...]},
+                   ...],
+        "exhaustive": true,
+        "layouts": [{"instruments": [...], "labware": [...], "modules": []},
+                    ...],
+        "configurations": {"0.0": 0, "1.0": 1, ...},
+        "errors": {"1.1": "AssertionError: ..."}
+    }
+
+A configuration's signature is the index of its value in the `choices` of
+each field, in field order, joined by dots. `configurations` maps it to
+its index in `layouts`, so all zeros is the default configuration. When
+the combinations of a protocol outnumber `--max-combinations`, each field
+is only varied on its own, with the other fields left at their defaults,
+and `exhaustive` is false. Configurations that fail, or take more than
+`--timeout` seconds, are listed in `errors`.
+
+    python -m protolib.parse.layouts [-j JOBS] [--force] \
+        [--max-combinations N] [--timeout 60] [PROTOCOL ...]
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import traceback
+from collections import defaultdict
+from pathlib import Path
+
+from protolib import store
+from protolib.parse import batch, cache
+from protolib.traversals import find_ot2_protocols, ot2_build_path
+
+LAYOUTS_SUFFIX = '.layouts.json'
+# bump whenever the sweep or the layouts file changes
+LAYOUTS_FORMAT = 1
+MAX_COMBINATIONS = 128
+TIMEOUT = 60
+
+
+def field_choices(field):
+    """
+    Returns the values of :param:field to simulate, its default first.
+    """
+    if field['type'] == 'dropDown':
+        return [option['value'] for option in field['options']]
+    default = field.get('default')
+    # sample and column counts are what usually change the deck,
+    # and the smallest count is always a valid one
+    if field['type'] == 'int' and isinstance(default, int) and default > 1:
+        return [default, 1]
+    return [default]
+
+
+def signatures(choices, max_combinations=MAX_COMBINATIONS):
+    """
+    Returns the choice index tuples to simulate, given the number of
+    :param:choices of each field, and whether they are all combinations.
+    """
+    total = 1
+    for count in choices:
+        total *= count
+    if total <= max_combinations:
+        return list(itertools.product(*(range(c) for c in choices))), True
+    indexes = [tuple(0 for _ in choices)]
+    for i, count in enumerate(choices):
+        for choice in range(1, count):
+            indexes.append(tuple(
+                choice if j == i else 0 for j in range(len(choices))))
+    return indexes, False
+
+
+def layouts_path(protocol_path):
+    dest_path = ot2_build_path(protocol_path)
+    return dest_path.with_name(dest_path.name[:-len('.json')] + LAYOUTS_SUFFIX)
+
+
+def layouts_key(protocol_path, opentrons_version, max_combinations):
+    digest = hashlib.sha256()
+    for part in (cache.protocol_key(protocol_path, opentrons_version),
+                 LAYOUTS_FORMAT, max_combinations):
+        digest.update('{}\0'.format(part).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def read_fields(protocol_path):
+    fields_json_path = Path(protocol_path).parent / 'fields.json'
+    if not fields_json_path.is_file():
+        return []
+    with open(fields_json_path) as f:
+        return json.load(f)
+
+
+def _simulate(job):
+    protocol_path, signature, values, timeout = job
+    limit = batch.TimeLimit(timeout)
+    try:
+        with limit:
+            batch._parser.reset_hardware(batch._hardware)
+            result = batch._parser.parse(
+                str(protocol_path), hardware=batch._hardware, values=values)
+    except (Exception, batch.SimulationTimeout):
+        error = traceback.format_exc().strip().splitlines()[-1]
+        if limit.expired:
+            error = 'SimulationTimeout: took more than {}s'.format(timeout)
+        return protocol_path, signature, None, error
+    layout = {
+        key: result[key] for key in ('instruments', 'labware', 'modules')}
+    return protocol_path, signature, layout, None
+
+
+def get_sweeps(protocol_paths, force=False, max_combinations=MAX_COMBINATIONS,
+               timeout=TIMEOUT):
+    """
+    Returns {protocol path: (fields, exhaustive, layouts key)} and the
+    simulation jobs of every protocol whose layouts are not up to date.
+    """
+    opentrons_version = cache.get_opentrons_version()
+    sweeps = {}
+    jobs = []
+    for protocol_path in protocol_paths:
+        key = layouts_key(protocol_path, opentrons_version, max_combinations)
+        if not force and cache.is_fresh(layouts_path(protocol_path), key):
+            continue
+        fields = [
+            {'name': field['name'], 'choices': field_choices(field)}
+            for field in read_fields(protocol_path)]
+        indexes, exhaustive = signatures(
+            [len(field['choices']) for field in fields], max_combinations)
+        sweeps[protocol_path] = (fields, exhaustive, key)
+        for index in indexes:
+            values = {
+                field['name']: field['choices'][choice]
+                for field, choice in zip(fields, index)}
+            jobs.append((
+                protocol_path, '.'.join(str(i) for i in index), values,
+                timeout))
+    return sweeps, jobs
+
+
+def build_layouts(fields, exhaustive, results):
+    """
+    Returns the layouts file of a protocol from its
+    (signature, layout, error) simulation results.
+    """
+    layouts = []
+    layout_indexes = {}
+    configurations = {}
+    errors = {}
+    for signature, layout, error in sorted(results):
+        if error is not None:
+            errors[signature] = error
+            continue
+        layout_digest = store.json_digest(layout)
+        if layout_digest not in layout_indexes:
+            layout_indexes[layout_digest] = len(layouts)
+            layouts.append(layout)
+        configurations[signature] = layout_indexes[layout_digest]
+    return {
+        'fields': fields,
+        'exhaustive': exhaustive,
+        'layouts': layouts,
+        'configurations': configurations,
+        'errors': errors
+    }
+
+
+def run_sweeps(sweeps, jobs, processes=None):
+    """
+    Simulates every job on a pool of :param:processes workers and writes
+    the layouts file of each swept protocol.
+    """
+    results = defaultdict(list)
+    if jobs:
+        processes = min(processes or os.cpu_count() or 1, len(jobs))
+        with multiprocessing.Pool(
+                processes, initializer=batch._init_worker) as pool:
+            for i, (protocol_path, signature, layout, error) in enumerate(
+                    pool.imap_unordered(_simulate, jobs), 1):
+                print('[{}/{}] {} {} {}'.format(
+                    i, len(jobs), 'FAILED' if error else 'simulated',
+                    protocol_path, signature))
+                results[protocol_path].append((signature, layout, error))
+
+    for protocol_path, (fields, exhaustive, key) in sweeps.items():
+        dest_path = layouts_path(protocol_path)
+        os.makedirs(str(dest_path.parent), exist_ok=True)
+        with open(dest_path, 'w') as f:
+            json.dump(
+                build_layouts(fields, exhaustive, results[protocol_path]),
+                f, sort_keys=True, separators=(',', ':'))
+        cache.write_key(dest_path, key)
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(
+        prog='python -m protolib.parse.layouts',
+        description='Simulate the deck layout of every field configuration '
+                    'of OT2 APIv2 protocols.')
+    arg_parser.add_argument(
+        'protocols', nargs='*',
+        help='protocol files to sweep (default: every OT2 APIv2 protocol)')
+    arg_parser.add_argument(
+        '-j', '--jobs', type=int, default=None,
+        help='number of worker processes (default: number of CPUs)')
+    arg_parser.add_argument(
+        '--force', action='store_true',
+        help='sweep protocols even if their layouts are up to date')
+    arg_parser.add_argument(
+        '--max-combinations', type=int, default=MAX_COMBINATIONS,
+        help='only vary one field at a time above this many combinations '
+             '(default: {})'.format(MAX_COMBINATIONS))
+    arg_parser.add_argument(
+        '--timeout', type=float, default=TIMEOUT,
+        help='seconds per simulation (default: {})'.format(TIMEOUT))
+    args = arg_parser.parse_args(argv)
+
+    protocol_paths = args.protocols or list(find_ot2_protocols())
+    sweeps, jobs = get_sweeps(
+        protocol_paths, args.force, args.max_combinations, args.timeout)
+    print('OT2 APIv2: sweeping {} of {} protocols, {} simulations'.format(
+        len(sweeps), len(protocol_paths), len(jobs)))
+    run_sweeps(sweeps, jobs, args.jobs)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
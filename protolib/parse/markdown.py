@@ -1,6 +1,6 @@
 import re
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, Comment, NavigableString
 import markdown
 
 # NOTE(IL, 2021-03-16): these were gathered from existing READMEs.
@@ -26,30 +26,74 @@ ALLOWED_HEADERS = [
     'title'
 ]
 
+IS_TITLE = re.compile(r'# +(.+)')
+IS_HEADER = re.compile(r'^ *##+ *(.*)$')
+
+# All sections of a README are rendered as one markdown document, with
+# this raw HTML comment between them, and split up again in the DOM.
+SECTION_BREAK = 'protolib:section-break'
+# Reference-style links would resolve across sections in that case, so
+# documents that define them are rendered one section at a time.
+IS_LINK_REFERENCE = re.compile(r'^ {0,3}\[[^\]]+\]:', re.MULTILINE)
+
+# Building a Markdown instance is expensive, so one is reused (and reset)
+# for every conversion
+_markdown = markdown.Markdown()
+
 
 def markdown_to_dom(text):
     """
     Parses :param:text into BeautifulSoup HTML DOM
     """
-    html = markdown.markdown(text)
+    html = _markdown.reset().convert(text)
     return BeautifulSoup(html, 'html.parser')
 
 
-def parse_list(text):
+def _strip_dom(dom):
+    # markdown strips its output, so trim the whitespace that was
+    # rendered around the section breaks
+    for index, strip in ((0, str.lstrip), (-1, str.rstrip)):
+        if dom.contents and type(dom.contents[index]) is NavigableString:
+            text = strip(str(dom.contents[index]))
+            if text:
+                dom.contents[index].replace_with(text)
+            else:
+                dom.contents[index].extract()
+    return dom
+
+
+def sections_to_dom(sections):
     """
-    Converts extracts list items from
-    markdown and converts them into the list of strings.
+    Renders a list of markdown sections with a single markdown and
+    BeautifulSoup pass. Returns one DOM per section, each equivalent
+    to `markdown_to_dom(section)`.
     """
-    dom = markdown_to_dom(text)
+    if any(IS_LINK_REFERENCE.search(section) for section in sections):
+        return [markdown_to_dom(section) for section in sections]
+
+    separator = '\n\n<!--{}-->\n\n'.format(SECTION_BREAK)
+    soup = markdown_to_dom(separator.join(sections))
+    doms = [soup.new_tag('div')]
+    for node in list(soup.contents):
+        if isinstance(node, Comment) and node == SECTION_BREAK:
+            doms.append(soup.new_tag('div'))
+        else:
+            doms[-1].append(node.extract())
+
+    if len(doms) != len(sections):
+        # an unclosed raw HTML block swallowed a section break
+        return [markdown_to_dom(section) for section in sections]
+    return [_strip_dom(dom) for dom in doms]
+
+
+def list_items(dom):
     return [
         item.get_text()
         for item in dom.find_all('li')
     ]
 
 
-def parse_nested_list(text):
-    soup = BeautifulSoup(markdown.markdown(text), 'html.parser')
-
+def nested_list_items(dom):
     def get_list(el):
         el = el.find('ol') or el.find('ul')
         return el.find_all('li', recursive=False) if el else []
@@ -59,16 +103,32 @@ def parse_nested_list(text):
             next(li.stripped_strings): parse(get_list(li))
             for li in lis
         }
-    tree = parse(get_list(soup))
+    tree = parse(get_list(dom))
     return {k: list(sorted(v.keys())) for k, v in tree.items()}
 
 
+def dom_text(dom):
+    return dom.get_text()
+
+
+def parse_list(text):
+    """
+    Converts extracts list items from
+    markdown and converts them into the list of strings.
+    """
+    return list_items(markdown_to_dom(text))
+
+
+def parse_nested_list(text):
+    return nested_list_items(markdown_to_dom(text))
+
+
 def get_text(document):
     """
     :param:document markdown document
     Returns text-only representation of the document.
     """
-    return markdown_to_dom(document).get_text()
+    return dom_text(markdown_to_dom(document))
 
 
 def get_title(document):
@@ -76,10 +136,9 @@ def get_title(document):
     :param:document list of strings representing the document
     Returns the title of the document.
     """
-    is_title = re.compile(r'# +(.+)')
     # Return next or none of there's nothing
     title = next((
-        x for x in map(is_title.match, document)
+        x for x in map(IS_TITLE.match, document)
         if x is not None
     ), None)
 
@@ -87,8 +146,7 @@ def get_title(document):
 
 
 def get_header(line):
-    is_header = re.compile(r'^ *##+ *(.*)$')
-    res = is_header.match(line)
+    res = IS_HEADER.match(line)
     return res.group(1) if res else None
 
 
@@ -109,20 +167,28 @@ def header_to_key(header):
     return overrides.get(header, header)
 
 
+def convert_dom(key, dom):
+    """
+    Given :param:key and the rendered :param:dom of its value
+    converts it to an object defined by mapping.
+    """
+    handlers = {
+        'categories': nested_list_items,
+        'subcategories': list_items,
+        'modules': list_items,
+        'robot': list_items,
+        'reagents': list_items
+    }
+    return handlers.get(key, dom_text)(dom)
+
+
 def convert_value(key, value):
     """
     Given :param:key and :param:value
     converts value from markdown to an object
     defined by mapping.
     """
-    handlers = {
-        'categories': parse_nested_list,
-        'subcategories': parse_list,
-        'modules': parse_list,
-        'robot': parse_list,
-        'reagents': parse_list
-    }
-    return handlers.get(key, get_text)(value)
+    return convert_dom(key, markdown_to_dom(value))
 
 
 def split_markdown(document):
@@ -180,9 +246,11 @@ def parse_values(document):
     from markdown into their standard form
     (i.e. converting bullets to lists)
     """
+    keys = list(document.keys())
+    doms = sections_to_dom([document[key] for key in keys])
     return {
-        key: convert_value(key, value)
-        for key, value in document.items()
+        key: convert_dom(key, dom)
+        for key, dom in zip(keys, doms)
     }
 
 
@@ -1,11 +1,17 @@
+import hashlib
 import json
 import sys
+from contextlib import ExitStack
 from pathlib import Path
 import opentrons
+from opentrons.commands import types as command_types
+from opentrons.hardware_control import API, ThreadManager
 from opentrons.protocols.execution.execute import run_protocol
 from opentrons.protocols.parse import parse as parse_protocol
 from opentrons.protocols.context.simulator.protocol_context \
     import ProtocolContextSimulation
+from protolib import bundle, store
+from protolib.parse import cache, commands, consumables, timing
 
 
 def filter_none(arr):
@@ -53,6 +59,33 @@ def parse_labware(slot, labware):
         'share': False}
 
 
+# parsed custom labware definitions and their labware store digests,
+# keyed by the sha256 of their file
+_labware_defs = {}
+
+
+def load_labware_definition(labware_path):
+    """
+    Parses a custom labware JSON once per process, even if several
+    protocols ship the same file. Returns (definition, store digest).
+    """
+    with open(labware_path, 'rb') as lf:
+        raw = lf.read()
+    file_hash = hashlib.sha256(raw).hexdigest()
+    if file_hash not in _labware_defs:
+        labware_def = json.loads(raw.decode('utf-8'))
+        _labware_defs[file_hash] = (
+            labware_def, store.json_digest(labware_def))
+    return _labware_defs[file_hash]
+
+
+def labware_uri(labware_def):
+    return '{}/{}/{}'.format(
+        labware_def['namespace'],
+        labware_def['parameters']['loadName'],
+        labware_def['version'])
+
+
 def get_default_field_value(field):
     if field['type'] == 'dropDown':
         return field['options'][0]['value']
@@ -69,7 +102,31 @@ def get_values(*field_names):
     return get_values_content + protocol_content
 
 
-def parse(protocol_path):
+def build_hardware():
+    """
+    Builds a simulating hardware controller that can be shared by several
+    consecutive `parse` calls (see `protolib.parse.batch`).
+    """
+    return ThreadManager(API.build_hardware_simulator)
+
+
+def reset_hardware(hardware):
+    """
+    Clears instruments, positions and tip state left behind by the
+    previous protocol simulated on :param:hardware.
+    """
+    hardware.sync.reset()
+
+
+def parse(protocol_path, hardware=None, profile=None, values=None,
+          recorder=None):
+    """
+    Simulates the protocol at :param:protocol_path with its default field
+    values, or with :param:values for the fields it names. Pass a
+    `profiling.SimulationProfile` as :param:profile to time and profile
+    the simulation, and a `commands.CommandRecorder` as :param:recorder
+    to keep the commands it executes.
+    """
     if not protocol_path:
         print('No protocol path... something weird happened!')
         return {}
@@ -79,7 +136,9 @@ def parse(protocol_path):
     has_fields = Path(fields_json_path).is_file()
 
     with open(protocol_path) as f:
-        original_contents = f.read()
+        # simulate and serve the protocol with its otcustomizers helpers
+        # inlined, as the robot needs a single file
+        original_contents = bundle.cached_bundle(f.read())
 
     fields = []
     contents = original_contents
@@ -90,25 +149,35 @@ def parse(protocol_path):
             # the default values
             default_values = {
                 f['name']: get_default_field_value(f) for f in fields}
+            default_values.update(values or {})
             contents = prepend_get_values_fn(original_contents, default_values)
 
     # load any custom labware in protocols/{PROTOCOL_SLUG}/labware/*.json
-    custom_labware_defs = []
+    # into an overlay that only this simulation sees, instead of saving it to
+    # the shared user labware dir (slow, and racy between parallel parses)
+    custom_labware = []
     custom_labware_path = Path(protocol_path).parent / 'labware'
     if custom_labware_path.is_dir():
-        for l_path in custom_labware_path.iterdir():
-            with open(l_path) as lf:
-                custom_labware_defs.append(json.load(lf))
-    for labware_def in custom_labware_defs:
-        opentrons.protocol_api.labware.save_definition(labware_def, force=True)
+        custom_labware = [
+            load_labware_definition(l_path)
+            for l_path in sorted(custom_labware_path.iterdir())]
+    extra_labware = {
+        labware_uri(labware_def): labware_def
+        for labware_def, _ in custom_labware}
+    # each unique definition is stored once, builds refer to it by digest
+    custom_labware_refs = [
+        store.put_json(store.LABWARE, labware_def, digest)
+        for labware_def, digest in custom_labware]
 
     protocol = parse_protocol(
         protocol_file=contents, filename=protocol_path)
 
     assert protocol.api_level >= (2, 0)
 
-    # Use a simulating protocol context
-    context_impl = ProtocolContextSimulation()
+    # Use a simulating protocol context. Without :param:hardware, the context
+    # builds (and later discards) its own simulating hardware controller.
+    context_impl = ProtocolContextSimulation(
+        hardware=hardware, extra_labware=extra_labware)
 
     context = opentrons.protocol_api.contexts.ProtocolContext(
         implementation=context_impl)
@@ -118,14 +187,27 @@ def parse(protocol_path):
     # LabwareHeightError even though they're safe to use.
     # So we'll apply a HACK-y -25 offset of the deck.
     context.home()
-    run_protocol(protocol, context=context)
-
-    instruments = [{'mount': mount, 'name': pipette.name} for mount,
-                   pipette in context.loaded_instruments.items() if pipette]
-
-    labware = filter_none([parse_labware(slot, labware)
-                           for slot, labware
-                           in context.loaded_labwares.items()])
+    # the command stream is always recorded for the run-time estimate
+    recorder = recorder or commands.CommandRecorder()
+    try:
+        with ExitStack() as stack:
+            stack.callback(context.broker.subscribe(
+                command_types.COMMAND, recorder.on_command))
+            if profile is not None:
+                stack.callback(context.broker.subscribe(
+                    command_types.COMMAND, profile.on_command))
+                stack.enter_context(profile.measure())
+            run_protocol(protocol, context=context)
+
+        instruments = [{'mount': mount, 'name': pipette.name} for mount,
+                       pipette in context.loaded_instruments.items()
+                       if pipette]
+
+        labware = filter_none([parse_labware(slot, labware)
+                               for slot, labware
+                               in context.loaded_labwares.items()])
+    finally:
+        context.cleanup()
 
     # NOTE: this isn't really used right now...
     metadata = protocol.metadata
@@ -142,16 +224,29 @@ def parse(protocol_path):
         "fields": fields,
         "modules": modules,
         "metadata": metadata,
-        "content": original_contents,
-        "custom_labware_defs": custom_labware_defs
+        # the source is stored once and resolved again by protolib.merge
+        "content_ref": store.put_json(store.SOURCE, original_contents),
+        "custom_labware_refs": custom_labware_refs,
+        "time_estimate": timing.estimate(recorder.stream),
+        "consumables": consumables.count_consumables(
+            recorder.stream, labware)
     }
 
 
+def write_build(result, dest_path):
+    with open(dest_path, 'w') as f:
+        json.dump(result, f, sort_keys=True, separators=(',', ':'))
+
+
 if __name__ == '__main__':
     sourceFilePath = sys.argv[1]
     destFilePath = sys.argv[2]
+    build_key = cache.protocol_key(
+        sourceFilePath, cache.get_opentrons_version())
+    if cache.is_fresh(destFilePath, build_key):
+        print('OT2 APIv2: {} is up to date'.format(destFilePath))
+        sys.exit(0)
     print('OT2 APIv2: parsing {} to {}'.format(sourceFilePath, destFilePath))
 
-    result = parse(sourceFilePath)
-    with open(destFilePath, 'w') as f:
-        json.dump(result, f, indent=4, sort_keys=True)
+    write_build(parse(sourceFilePath), destFilePath)
+    cache.write_key(destFilePath, build_key)
@@ -0,0 +1,150 @@
+"""
+Opt-in profiling of OT2 protocol simulation.
+
+`python -m protolib.parse --profile` passes a `SimulationProfile` to
+`parseOT2v2.parse` for every protocol and saves its summary (simulation
+wall time, number of executed commands and the top functions from
+cProfile) next to the build JSON as `<name>.ot2.apiv2.py.json.profile.json`.
+
+    python -m protolib.parse.profiling [--top N]
+
+aggregates those files into a library-wide report. Functions defined in
+protocol files are grouped by name, so helpers copy-pasted across many
+protocols (`_pick_up`, `h_track`...) show up as a single entry.
+"""
+import argparse
+import cProfile
+import json
+import os
+import pstats
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+from protolib.traversals import PROTOCOL_DIR, PROTOCOLS_BUILD_DIR
+
+PROFILE_SUFFIX = '.profile.json'
+# number of functions kept per protocol, by own time and by cumulative time
+TOP_FUNCTIONS = 30
+
+
+class SimulationProfile(object):
+    def __init__(self):
+        self.profiler = cProfile.Profile()
+        self.wall_seconds = 0.0
+        self.commands = 0
+
+    def on_command(self, message):
+        # the broker publishes every command before and after it runs
+        if message['$'] == 'before':
+            self.commands += 1
+
+    @contextmanager
+    def measure(self):
+        start = time.perf_counter()
+        self.profiler.enable()
+        try:
+            yield
+        finally:
+            self.profiler.disable()
+            self.wall_seconds += time.perf_counter() - start
+
+    def summary(self, top=TOP_FUNCTIONS):
+        stats = pstats.Stats(self.profiler).stats
+        functions = [
+            {
+                'function': function_name(file_name, line, name),
+                'calls': calls,
+                'tottime': tottime,
+                'cumtime': cumtime
+            }
+            for (file_name, line, name), (_, calls, tottime, cumtime, _)
+            in stats.items()]
+        top_functions = {
+            f['function']: f
+            for key in ('tottime', 'cumtime')
+            for f in sorted(functions, key=lambda f: f[key])[-top:]}
+        return {
+            'wall_seconds': self.wall_seconds,
+            'commands': self.commands,
+            'functions': sorted(
+                top_functions.values(),
+                key=lambda f: f['tottime'], reverse=True)
+        }
+
+
+def function_name(file_name, line, name):
+    # keep names comparable between machines and virtualenvs
+    if 'site-packages' + os.sep in file_name:
+        file_name = file_name.split('site-packages' + os.sep, 1)[1]
+    elif os.path.isabs(file_name) and file_name.startswith(os.getcwd()):
+        file_name = os.path.relpath(file_name)
+    return '{}:{}({})'.format(file_name, line, name)
+
+
+def profile_path(dest_path):
+    return Path('{}{}'.format(dest_path, PROFILE_SUFFIX))
+
+
+def write_profile(profile, dest_path):
+    with open(profile_path(dest_path), 'w') as f:
+        json.dump(profile.summary(), f, indent=4, sort_keys=True)
+
+
+def aggregate(build_dir=PROTOCOLS_BUILD_DIR):
+    """
+    Returns the per-protocol totals and the per-function totals of
+    every saved profile under :param:build_dir.
+    """
+    protocols = []
+    functions = defaultdict(
+        lambda: {'calls': 0, 'tottime': 0.0, 'cumtime': 0.0, 'protocols': 0})
+    for path in sorted(Path(build_dir).rglob('*' + PROFILE_SUFFIX)):
+        with open(path) as f:
+            profile = json.load(f)
+        protocols.append({
+            'protocol': str(path)[:-len(PROFILE_SUFFIX)],
+            'wall_seconds': profile['wall_seconds'],
+            'commands': profile['commands']})
+        for f in profile['functions']:
+            name = f['function']
+            if name.startswith(PROTOCOL_DIR + os.sep):
+                # same helper, copy-pasted into different protocols
+                name = 'protocols/*:{}'.format(name.rsplit('(', 1)[1][:-1])
+            functions[name]['calls'] += f['calls']
+            functions[name]['tottime'] += f['tottime']
+            functions[name]['cumtime'] += f['cumtime']
+            functions[name]['protocols'] += 1
+    return protocols, dict(functions)
+
+
+def print_report(top):
+    protocols, functions = aggregate()
+    total = sum(p['wall_seconds'] for p in protocols)
+    print('{} profiled protocols, {:.1f}s of simulation'.format(
+        len(protocols), total))
+
+    print('\nSlowest protocols:')
+    print('{:>9} {:>9}  {}'.format('seconds', 'commands', 'protocol'))
+    for p in sorted(protocols, key=lambda p: p['wall_seconds'],
+                    reverse=True)[:top]:
+        print('{:>9.2f} {:>9}  {}'.format(
+            p['wall_seconds'], p['commands'], p['protocol']))
+
+    print('\nHottest functions (own time summed over protocols):')
+    print('{:>9} {:>9} {:>10}  {}'.format(
+        'tottime', 'cumtime', 'protocols', 'function'))
+    for name, f in sorted(functions.items(), key=lambda item: item[1][
+            'tottime'], reverse=True)[:top]:
+        print('{:>9.2f} {:>9.2f} {:>10}  {}'.format(
+            f['tottime'], f['cumtime'], f['protocols'], name))
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        prog='python -m protolib.parse.profiling',
+        description='Aggregate the simulation profiles saved in protoBuilds.')
+    arg_parser.add_argument(
+        '--top', type=int, default=20, help='number of rows per table')
+    print_report(arg_parser.parse_args().top)
@@ -0,0 +1,151 @@
+"""
+Consumables of OT2 APIv2 protocols for other sample counts.
+
+The build JSON only holds the consumables of the default field values.
+This sweep simulates each protocol with a sample count field (see
+`consumables.sample_field`) again for the counts of
+`consumables.sample_counts`, each within `--timeout` seconds, and saves
+their consumables next to the build as
+`<name>.ot2.apiv2.py.samples.json`:
+
+    {"field": "num_samples", "counts": {"24": {...}, "48": {...}},
+     "errors": {"1": "AssertionError: ..."}}
+
+Sample counts that the protocol rejects or that time out are listed in
+`errors`.
+
+    python -m protolib.parse.samples [-j JOBS] [--force] [--timeout 60] \
+        [PROTOCOL ...]
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import traceback
+from collections import defaultdict
+
+from protolib.parse import batch, cache, consumables
+from protolib.parse.layouts import read_fields
+from protolib.traversals import find_ot2_protocols, ot2_build_path
+
+SAMPLES_SUFFIX = '.samples.json'
+# bump whenever the sweep or the samples file changes
+SAMPLES_FORMAT = 1
+TIMEOUT = 60
+
+
+def samples_path(protocol_path):
+    dest_path = ot2_build_path(protocol_path)
+    return dest_path.with_name(dest_path.name[:-len('.json')] + SAMPLES_SUFFIX)
+
+
+def samples_key(protocol_path, opentrons_version):
+    digest = hashlib.sha256()
+    for part in (cache.protocol_key(protocol_path, opentrons_version),
+                 SAMPLES_FORMAT):
+        digest.update('{}\0'.format(part).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _simulate(job):
+    protocol_path, count, values, timeout = job
+    limit = batch.TimeLimit(timeout)
+    try:
+        with limit:
+            batch._parser.reset_hardware(batch._hardware)
+            result = batch._parser.parse(
+                str(protocol_path), hardware=batch._hardware, values=values)
+    except (Exception, batch.SimulationTimeout):
+        error = traceback.format_exc().strip().splitlines()[-1]
+        if limit.expired:
+            error = 'SimulationTimeout: took more than {}s'.format(timeout)
+        return protocol_path, count, None, error
+    return protocol_path, count, result['consumables'], None
+
+
+def get_sweeps(protocol_paths, force=False, timeout=TIMEOUT):
+    """
+    Returns {protocol path: (sample field name, samples key)} and the
+    simulation jobs of every protocol whose sweep is not up to date.
+    """
+    opentrons_version = cache.get_opentrons_version()
+    sweeps = {}
+    jobs = []
+    for protocol_path in protocol_paths:
+        field = consumables.sample_field(read_fields(protocol_path))
+        if field is None:
+            continue
+        key = samples_key(protocol_path, opentrons_version)
+        if not force and cache.is_fresh(samples_path(protocol_path), key):
+            continue
+        sweeps[protocol_path] = (field['name'], key)
+        for count in consumables.sample_counts(field):
+            jobs.append((
+                protocol_path, str(count), {field['name']: count}, timeout))
+    return sweeps, jobs
+
+
+def run_sweeps(sweeps, jobs, processes=None):
+    """
+    Simulates every job on a pool of :param:processes workers and writes
+    the samples file of each swept protocol.
+    """
+    counts = defaultdict(dict)
+    errors = defaultdict(dict)
+    if jobs:
+        processes = min(processes or os.cpu_count() or 1, len(jobs))
+        with multiprocessing.Pool(
+                processes, initializer=batch._init_worker) as pool:
+            for i, (protocol_path, count, used, error) in enumerate(
+                    pool.imap_unordered(_simulate, jobs), 1):
+                print('[{}/{}] {} {} with {} samples'.format(
+                    i, len(jobs), 'FAILED' if error else 'simulated',
+                    protocol_path, count))
+                if error is None:
+                    counts[protocol_path][count] = used
+                else:
+                    errors[protocol_path][count] = error
+
+    for protocol_path, (field_name, key) in sweeps.items():
+        dest_path = samples_path(protocol_path)
+        os.makedirs(str(dest_path.parent), exist_ok=True)
+        with open(dest_path, 'w') as f:
+            json.dump({
+                'field': field_name,
+                'counts': counts[protocol_path],
+                'errors': errors[protocol_path]
+            }, f, sort_keys=True, separators=(',', ':'))
+        cache.write_key(dest_path, key)
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(
+        prog='python -m protolib.parse.samples',
+        description='Simulate the consumables of other sample counts of '
+                    'OT2 APIv2 protocols.')
+    arg_parser.add_argument(
+        'protocols', nargs='*',
+        help='protocol files to sweep (default: every OT2 APIv2 protocol)')
+    arg_parser.add_argument(
+        '-j', '--jobs', type=int, default=None,
+        help='number of worker processes (default: number of CPUs)')
+    arg_parser.add_argument(
+        '--force', action='store_true',
+        help='sweep protocols even if their samples file is up to date')
+    arg_parser.add_argument(
+        '--timeout', type=float, default=TIMEOUT,
+        help='seconds per simulation (default: {})'.format(TIMEOUT))
+    args = arg_parser.parse_args(argv)
+
+    protocol_paths = args.protocols or list(find_ot2_protocols())
+    sweeps, jobs = get_sweeps(protocol_paths, args.force, args.timeout)
+    print('OT2 APIv2: sweeping {} of {} protocols, {} simulations'.format(
+        len(sweeps), len(protocol_paths), len(jobs)))
+    run_sweeps(sweeps, jobs, args.jobs)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
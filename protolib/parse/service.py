@@ -0,0 +1,339 @@
+"""
+Local HTTP service that simulates OT2 APIv2 protocols with custom field
+values, for validating a configuration without paying for the opentrons
+import and simulator setup on every request.
+
+Workers (set up like those of `python -m protolib.parse`) each import
+opentrons and build their simulating hardware once, and take one request
+at a time. A worker that takes longer than `--timeout` is killed and
+replaced, so a hung simulation can't hold on to it. Results are kept in a
+bounded LRU cache keyed by the protocol's build key (its source, fields,
+labware and the opentrons version) and its normalized field values, so
+repeated configurations are answered without simulating.
+
+    python -m protolib.parse.service [--port 8000] [-j JOBS] \
+        [--cache-size 256] [--timeout 120]
+
+    POST /simulate {"slug": "1a2b3c", "values": {"pipette_type": "p20"}}
+    -> {"instruments": [...], "labware": [...], "modules": [...],
+        "warnings": [...], "errors": [...], "cached": false}
+
+`protocol` may name the protocol file when a slug has several. Values
+default to the field defaults, and values for unknown fields are an error.
+
+    GET /stats -> cache size, hits and misses
+"""
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import queue
+import sys
+import threading
+import traceback
+import warnings
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from protolib import store
+from protolib.parse import batch, cache
+from protolib.parse.layouts import read_fields
+from protolib.traversals import PROTOCOL_DIR
+
+DEFAULT_PORT = 8000
+CACHE_SIZE = 256
+# seconds a simulation may take before the request fails
+TIMEOUT = 120
+# workers replaced while requests are served are started from the fork
+# server, not forked from the threaded server, whose locks other threads
+# may be holding
+WORKER_CONTEXT = multiprocessing.get_context('forkserver')
+
+
+class RequestError(Exception):
+    pass
+
+
+class LRUCache(object):
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses}
+
+
+class WarningCollector(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def find_protocol(slug, name=None):
+    """
+    Returns the path of the OT2 APIv2 protocol :param:name (or the only
+    one) of the protocol dir :param:slug.
+    """
+    protocol_dir = Path(PROTOCOL_DIR) / str(slug)
+    if '/' in str(slug) or str(slug).startswith('.') or \
+            not protocol_dir.is_dir():
+        raise RequestError('unknown protocol slug: {}'.format(slug))
+    protocol_paths = sorted(protocol_dir.glob('*.ot2.apiv2.py'))
+    if name is not None:
+        protocol_paths = [p for p in protocol_paths if p.name == name]
+    if len(protocol_paths) != 1:
+        raise RequestError(
+            '{} OT2 APIv2 protocols match, pass "protocol" to pick one of '
+            '{}'.format(len(protocol_paths), [
+                p.name for p in protocol_dir.glob('*.ot2.apiv2.py')]))
+    return protocol_paths[0]
+
+
+def coerce_value(field, value):
+    if field['type'] == 'dropDown':
+        options = [option['value'] for option in field['options']]
+        if value not in options:
+            raise RequestError('{}: {!r} is not one of {!r}'.format(
+                field['name'], value, options))
+        return value
+    try:
+        if field['type'] == 'int':
+            return int(value)
+        if field['type'] == 'float':
+            return float(value)
+    except (TypeError, ValueError):
+        raise RequestError('{}: {!r} is not a valid {}'.format(
+            field['name'], value, field['type']))
+    return value
+
+
+def normalize_values(fields, values):
+    """
+    Returns :param:values for every field of the protocol, filled in
+    with the field defaults and coerced to the field types.
+    """
+    if not isinstance(values, dict):
+        raise RequestError('"values" must be a JSON object')
+    names = {field['name'] for field in fields}
+    unknown = set(values) - names
+    if unknown:
+        raise RequestError('unknown fields: {}'.format(
+            ', '.join(sorted(unknown))))
+    normalized = {}
+    for field in fields:
+        if field['name'] in values:
+            normalized[field['name']] = coerce_value(
+                field, values[field['name']])
+        elif field['type'] == 'dropDown':
+            normalized[field['name']] = field['options'][0]['value']
+        else:
+            normalized[field['name']] = field.get('default')
+    return normalized
+
+
+def result_key(protocol_path, opentrons_version, values):
+    digest = hashlib.sha256()
+    digest.update(cache.protocol_key(
+        protocol_path, opentrons_version).encode('ascii'))
+    digest.update(store.canonical_json(values).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _simulate(job):
+    protocol_path, values = job
+    result = {}
+    errors = []
+    collector = WarningCollector()
+    logging.getLogger().addHandler(collector)
+    try:
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            try:
+                batch._parser.reset_hardware(batch._hardware)
+                result = batch._parser.parse(
+                    str(protocol_path), hardware=batch._hardware,
+                    values=values)
+            except Exception as e:
+                errors.append('{}: {}'.format(type(e).__name__, e))
+                traceback.print_exc()
+    finally:
+        logging.getLogger().removeHandler(collector)
+    return {
+        'instruments': result.get('instruments', []),
+        'labware': result.get('labware', []),
+        'modules': result.get('modules', []),
+        'warnings': collector.messages + [str(w.message) for w in caught],
+        'errors': errors
+    }
+
+
+def _serve(connection):
+    batch._init_worker()
+    while True:
+        job = connection.recv()
+        if job is None:
+            break
+        connection.send(_simulate(job))
+
+
+class Worker(object):
+    def __init__(self):
+        self.connection, child = WORKER_CONTEXT.Pipe()
+        self.process = WORKER_CONTEXT.Process(
+            target=_serve, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+
+    def run(self, job, timeout):
+        """
+        Returns the result of :param:job, or raises
+        `multiprocessing.TimeoutError` after :param:timeout seconds.
+        """
+        self.connection.send(job)
+        if not self.connection.poll(timeout):
+            raise multiprocessing.TimeoutError()
+        return self.connection.recv()
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+        self.connection.close()
+
+
+class SimulationService(object):
+    def __init__(self, processes=None, cache_size=CACHE_SIZE,
+                 timeout=TIMEOUT):
+        self.opentrons_version = cache.get_opentrons_version()
+        self.idle = queue.Queue()
+        for _ in range(processes or multiprocessing.cpu_count()):
+            self.idle.put(Worker())
+        self.results = LRUCache(cache_size)
+        self.timeout = timeout
+
+    def simulate(self, request):
+        protocol_path = find_protocol(
+            request.get('slug'), request.get('protocol'))
+        values = normalize_values(
+            read_fields(protocol_path), request.get('values') or {})
+        key = result_key(protocol_path, self.opentrons_version, values)
+        result = self.results.get(key)
+        if result is not None:
+            return {**result, 'cached': True}
+        worker = self.idle.get()
+        try:
+            result = worker.run((protocol_path, values), self.timeout)
+        except (multiprocessing.TimeoutError, EOFError, OSError):
+            # the worker is stuck or died: replace it
+            worker.stop()
+            worker = Worker()
+            raise
+        finally:
+            self.idle.put(worker)
+        self.results.put(key, result)
+        return {**result, 'cached': False}
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get().stop()
+
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, status, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path != '/stats':
+                return self.send_json(404, {'error': 'not found'})
+            self.send_json(200, service.results.stats())
+
+        def do_POST(self):
+            if self.path != '/simulate':
+                return self.send_json(404, {'error': 'not found'})
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length) or b'{}')
+                if not isinstance(request, dict):
+                    raise RequestError('expected a JSON object')
+                self.send_json(200, service.simulate(request))
+            except (RequestError, ValueError) as e:
+                self.send_json(400, {'error': str(e)})
+            except multiprocessing.TimeoutError:
+                self.send_json(504, {'error': 'simulation timed out'})
+            except Exception as e:
+                traceback.print_exc()
+                self.send_json(500, {'error': '{}: {}'.format(
+                    type(e).__name__, e)})
+
+    return Handler
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(
+        prog='python -m protolib.parse.service',
+        description='Serve OT2 APIv2 protocol simulations over HTTP.')
+    arg_parser.add_argument(
+        '--host', default='127.0.0.1', help='address to listen on')
+    arg_parser.add_argument(
+        '--port', type=int, default=DEFAULT_PORT,
+        help='port to listen on (default: {})'.format(DEFAULT_PORT))
+    arg_parser.add_argument(
+        '-j', '--jobs', type=int, default=None,
+        help='number of worker processes (default: number of CPUs)')
+    arg_parser.add_argument(
+        '--cache-size', type=int, default=CACHE_SIZE,
+        help='number of results to keep (default: {})'.format(CACHE_SIZE))
+    arg_parser.add_argument(
+        '--timeout', type=float, default=TIMEOUT,
+        help='seconds per simulation (default: {})'.format(TIMEOUT))
+    args = arg_parser.parse_args(argv)
+
+    service = SimulationService(args.jobs, args.cache_size, args.timeout)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    print('Serving simulations on http://{}:{}'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
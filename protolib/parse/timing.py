@@ -0,0 +1,199 @@
+"""
+Run-time estimate of a protocol from its simulated command stream.
+
+Every command is replayed through a simple timing model of the OT-2:
+gantry moves between the recorded deck coordinates at the default axis
+speeds (lifting to a travel height between slots), liquid handling at the
+recorded flow rates, fixed durations for tip handling and module actions,
+`delay` and thermocycler hold times, and temperature ramps from the last
+target temperature of each kind of module. Pauses wait for the user and
+are only counted.
+
+The estimate goes into each OT2 build JSON as `time_estimate`:
+
+    {
+        "total_seconds": 5123.4,
+        "pauses": 2,
+        "by_kind": {"aspirate": 812.0, "delay": 1800.0, ...},
+        "steps": [{"label": "Adding beads", "seconds": 640.2}, ...]
+    }
+
+Steps start at every top level `ctx.comment` or `ctx.pause`, and are
+labelled with its text.
+
+    python -m protolib.parse.timing [BUILD_DIR]
+
+estimates every command stream saved by `python -m protolib.parse
+--commands` and lists the longest protocols.
+"""
+import math
+import sys
+from collections import defaultdict
+
+from protolib.parse.commands import CONTAINERS, find_streams, read_commands
+from protolib.traversals import PROTOCOLS_BUILD_DIR
+
+# gantry position after homing and axis speeds, in mm and mm/s
+HOME = (418.0, 353.0, 205.0)
+XY_SPEED = 400.0
+Z_SPEED = 125.0
+# height the gantry lifts to when moving between slots
+TRAVEL_Z = 120.0
+# lift above the higher point when moving within a slot
+ARC_Z = 10.0
+# acceleration and settling overhead of every move
+MOVE_OVERHEAD = 0.2
+
+# seconds per command, on top of any move
+FIXED_SECONDS = {
+    'pick_up_tip': 2.0,
+    'drop_tip': 2.5,
+    'return_tip': 2.5,
+    'blow_out': 1.0,
+    'touch_tip': 2.0,
+    'home': 10.0,
+    'magdeck_engage': 5.0,
+    'magdeck_disengage': 5.0,
+    'thermocycler_open': 20.0,
+    'thermocycler_close': 20.0,
+}
+# how fast modules reach their target temperature, in degrees per second,
+# keyed by the commands that wait for it
+RAMP_RATES = {
+    'tempdeck_set_temp': ('tempdeck', 0.25),
+    'tempdeck_await_temp': ('tempdeck', 0.25),
+    'thermocycler_set_block_temp': ('thermocycler_block', 2.0),
+    'thermocycler_set_lid_temp': ('thermocycler_lid', 0.5),
+}
+# modules left to drift back to room temperature
+DEACTIVATED = {
+    'tempdeck_deactivate': ['tempdeck'],
+    'thermocycler_deactivate_block': ['thermocycler_block'],
+    'thermocycler_deactivate_lid': ['thermocycler_lid'],
+    'thermocycler_deactivate': ['thermocycler_block', 'thermocycler_lid'],
+}
+ROOM_TEMPERATURE = 25.0
+MAX_STEPS = 100
+
+
+def move_path(start, end):
+    """
+    Returns the horizontal and vertical mm the gantry travels between two
+    (x, y, z, slot) positions, arcing over the deck.
+    """
+    same_slot = start[3] == end[3] and start[3] >= 0
+    lift = max(start[2], end[2]) + ARC_Z if same_slot else max(
+        TRAVEL_Z, start[2], end[2])
+    vertical = (lift - start[2]) + (lift - end[2])
+    horizontal = math.hypot(end[0] - start[0], end[1] - start[1])
+    return horizontal, vertical
+
+
+def move_seconds(start, end):
+    horizontal, vertical = move_path(start, end)
+    return horizontal / XY_SPEED + vertical / Z_SPEED + MOVE_OVERHEAD
+
+
+def command_seconds(stream):
+    """
+    Yields (row index, kind, seconds) for every command in :param:stream.
+    """
+    columns = stream.columns
+    kinds = stream.tables['kind']
+    position = HOME + (-1,)
+    temperatures = defaultdict(lambda: ROOM_TEMPERATURE)
+    for i, kind_index in enumerate(columns['kind']):
+        kind = kinds[kind_index]
+        if kind in CONTAINERS:
+            yield i, kind, 0.0
+            continue
+        seconds = FIXED_SECONDS.get(kind, 0.0)
+
+        x = columns['x'][i]
+        if not math.isnan(x):
+            target = (x, columns['y'][i], columns['z'][i], columns['slot'][i])
+            seconds += move_seconds(position, target)
+            position = target
+        elif kind == 'home':
+            position = HOME + (-1,)
+
+        volume = columns['volume'][i]
+        flow_rate = columns['flow_rate'][i]
+        if not math.isnan(volume) and flow_rate > 0:
+            seconds += volume / flow_rate
+
+        if not math.isnan(columns['seconds'][i]):
+            seconds += columns['seconds'][i]
+
+        temperature = columns['temperature'][i]
+        if kind in RAMP_RATES and not math.isnan(temperature):
+            module, rate = RAMP_RATES[kind]
+            seconds += abs(temperature - temperatures[module]) / rate
+            temperatures[module] = temperature
+        for module in DEACTIVATED.get(kind, []):
+            temperatures.pop(module, None)
+        yield i, kind, seconds
+
+
+def get_steps(stream, amounts, key='seconds', max_steps=MAX_STEPS):
+    """
+    Sums the per-command :param:amounts of every step of :param:stream,
+    as {'label': ..., key: total} dicts.
+    """
+    labels = stream.labels()
+    depths = stream.columns['depth']
+    steps = []
+    for i, amount in enumerate(amounts):
+        if depths[i] == 0 and labels[i] is not None:
+            if not steps or steps[-1]['label'] != labels[i]:
+                steps.append({'label': labels[i], key: 0.0})
+        elif not steps:
+            steps.append({'label': '', key: 0.0})
+        steps[-1][key] += amount
+    if max_steps and len(steps) > max_steps:
+        rest = sum(step[key] for step in steps[max_steps - 1:])
+        steps = steps[:max_steps - 1] + [
+            {'label': '({} more steps)'.format(len(steps) - max_steps + 1),
+             key: rest}]
+    for step in steps:
+        step[key] = round(step[key], 1)
+    return steps
+
+
+def estimate(stream):
+    """
+    Returns the run-time estimate of a `commands.CommandStream`.
+    """
+    by_kind = defaultdict(float)
+    seconds = []
+    pauses = 0
+    for _, kind, row_seconds in command_seconds(stream):
+        by_kind[kind] += row_seconds
+        seconds.append(row_seconds)
+        pauses += kind == 'pause'
+    return {
+        'total_seconds': round(math.fsum(seconds), 1),
+        'pauses': pauses,
+        'by_kind': {
+            kind: round(total, 1) for kind, total in sorted(by_kind.items())
+            if total > 0},
+        'steps': get_steps(stream, seconds)
+    }
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}h{:02d}m{:02d}s'.format(hours, minutes, seconds)
+
+
+def print_estimates(build_dir=PROTOCOLS_BUILD_DIR):
+    estimates = [
+        (estimate(read_commands(path))['total_seconds'], path)
+        for path in find_streams(build_dir)]
+    for total_seconds, path in sorted(estimates, reverse=True):
+        print('{:>12}  {}'.format(format_duration(total_seconds), path))
+
+
+if __name__ == '__main__':
+    print_estimates(*sys.argv[1:2])
@@ -0,0 +1,146 @@
+"""
+Gantry travel of protocols, from their saved command streams.
+
+Replays the target coordinates of every command (see `commands.py`) with
+the same arcs as the run-time estimate, and counts:
+
+- the horizontal and vertical mm the gantry travels
+- tip rack round trips: tip pickups and returns that come from another slot
+- pipette swaps: consecutive commands that use different pipettes
+- mm per aspirate, to compare protocols that move different amounts
+
+    python -m protolib.parse.travel [--top N] [--build-dir DIR]
+    python -m protolib.parse.travel <build>.commands.bin [--top N]
+
+ranks every protocol with a saved command stream (`python -m
+protolib.parse --commands`) by total travel, or details one protocol: its
+steps and single moves with the most travel.
+"""
+import argparse
+import math
+import sys
+
+from protolib.parse.commands import CONTAINERS, find_streams, read_commands
+from protolib.parse.timing import HOME, get_steps, move_path
+from protolib.traversals import PROTOCOLS_BUILD_DIR
+
+TIP_COMMANDS = {'pick_up_tip', 'return_tip'}
+
+
+def analyze(stream, top=10):
+    """
+    Returns the travel totals of a `commands.CommandStream`, its
+    :param:top steps with the most travel and its :param:top longest moves.
+    """
+    columns = stream.columns
+    kinds = stream.kinds()
+    pipettes = stream.pipettes()
+    locations = stream.locations()
+
+    position = HOME + (-1,)
+    origin = 'home'
+    last_pipette = None
+    xy = z = 0.0
+    tip_trips = swaps = aspirates = 0
+    travel = []
+    moves = []
+    for i, kind in enumerate(kinds):
+        mm = 0.0
+        x = columns['x'][i]
+        if kind not in CONTAINERS and not math.isnan(x):
+            slot = columns['slot'][i]
+            target = (x, columns['y'][i], columns['z'][i], slot)
+            horizontal, vertical = move_path(position, target)
+            xy += horizontal
+            z += vertical
+            mm = horizontal + vertical
+            if kind in TIP_COMMANDS and slot != position[3]:
+                tip_trips += 1
+            destination = locations[i] or 'slot {}'.format(slot)
+            moves.append((mm, i, kind, pipettes[i], origin, destination))
+            position = target
+            origin = destination
+        elif kind == 'home':
+            position = HOME + (-1,)
+            origin = 'home'
+        if pipettes[i] is not None and kind not in CONTAINERS:
+            if last_pipette is not None and pipettes[i] != last_pipette:
+                swaps += 1
+            last_pipette = pipettes[i]
+        aspirates += kind == 'aspirate'
+        travel.append(mm)
+
+    steps = get_steps(stream, travel, key='mm', max_steps=None)
+    return {
+        'xy_mm': round(xy, 1),
+        'z_mm': round(z, 1),
+        'total_mm': round(xy + z, 1),
+        'tip_trips': tip_trips,
+        'pipette_swaps': swaps,
+        'aspirates': aspirates,
+        'commands': len(kinds),
+        'mm_per_aspirate': (
+            round((xy + z) / aspirates, 1) if aspirates else None),
+        'steps': sorted(
+            steps, key=lambda step: step['mm'], reverse=True)[:top],
+        'moves': [
+            {'command': i, 'kind': kind, 'pipette': pipette,
+             'from': origin, 'to': destination, 'mm': round(mm, 1)}
+            for mm, i, kind, pipette, origin, destination
+            in sorted(moves, reverse=True)[:top]]
+    }
+
+
+def print_ranking(build_dir, top):
+    results = []
+    for path in find_streams(build_dir):
+        results.append((analyze(read_commands(path), top=0), path))
+    results.sort(key=lambda result: result[0]['total_mm'], reverse=True)
+    print('{:>10} {:>10} {:>9} {:>6} {:>8}  {}'.format(
+        'travel m', 'mm/asp', 'tip trips', 'swaps', 'commands', 'protocol'))
+    for result, path in results[:top]:
+        print('{:>10.1f} {:>10} {:>9} {:>6} {:>8}  {}'.format(
+            result['total_mm'] / 1000,
+            result['mm_per_aspirate'] if result['mm_per_aspirate'] else '-',
+            result['tip_trips'], result['pipette_swaps'],
+            result['commands'], path))
+
+
+def print_detail(path, top):
+    result = analyze(read_commands(path), top)
+    print('{}: {:.1f} m of travel ({:.1f} m XY, {:.1f} m Z), {} tip rack '
+          'trips, {} pipette swaps, {} mm per aspirate'.format(
+              path, result['total_mm'] / 1000, result['xy_mm'] / 1000,
+              result['z_mm'] / 1000, result['tip_trips'],
+              result['pipette_swaps'], result['mm_per_aspirate']))
+    print('\nSteps with the most travel:')
+    for step in result['steps']:
+        print('{:>10.1f} mm  {}'.format(step['mm'], step['label'] or '-'))
+    print('\nLongest moves:')
+    for move in result['moves']:
+        print('{:>10.1f} mm  #{} {} {} -> {} ({})'.format(
+            move['mm'], move['command'], move['kind'], move['from'],
+            move['to'], move['pipette']))
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(
+        prog='python -m protolib.parse.travel',
+        description='Rank protocols by gantry travel, or detail one.')
+    arg_parser.add_argument(
+        'stream', nargs='?', help='a .commands.bin file to detail')
+    arg_parser.add_argument(
+        '--top', type=int, default=20, help='number of rows per table')
+    arg_parser.add_argument(
+        '--build-dir', default=PROTOCOLS_BUILD_DIR,
+        help='where to look for command streams')
+    args = arg_parser.parse_args(argv)
+    if args.stream:
+        print_detail(args.stream, args.top)
+    else:
+        print_ranking(args.build_dir, args.top)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
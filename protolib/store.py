@@ -0,0 +1,60 @@
+"""
+Content-addressed storage for data shared between protocol builds.
+
+Objects are stored once under `protoBuilds/_store/<kind>/` in a file named
+by the sha256 of their canonical JSON, and build files refer to them by
+that digest. Writes are atomic, so parallel parsers can store the same
+object at the same time.
+"""
+import hashlib
+import json
+import os
+
+from protolib.traversals import STORE_DIR
+
+LABWARE = 'labware'
+# protocol sources, stored as JSON strings
+SOURCE = 'source'
+# protocol sources with their helpers inlined, keyed by protolib.bundle
+BUNDLE = 'bundle'
+
+
+def canonical_json(obj):
+    return json.dumps(obj, sort_keys=True, separators=(',', ':'))
+
+
+def json_digest(obj):
+    return hashlib.sha256(canonical_json(obj).encode('utf-8')).hexdigest()
+
+
+def blob_path(kind, digest, store_dir=STORE_DIR):
+    return os.path.join(store_dir, kind, '{}.json'.format(digest))
+
+
+def put_json(kind, obj, digest=None, store_dir=STORE_DIR):
+    """
+    Stores :param:obj unless it is already stored. Returns its digest.
+    Pass :param:digest if it is already known to skip re-hashing.
+    """
+    digest = digest or json_digest(obj)
+    path = blob_path(kind, digest, store_dir)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as blob_file:
+            blob_file.write(canonical_json(obj))
+        os.replace(tmp_path, path)
+    return digest
+
+
+def read_blob(kind, digest, store_dir=STORE_DIR):
+    """
+    Returns the stored canonical JSON text of :param:digest.
+    """
+    with open(blob_path(kind, digest, store_dir), 'r') as blob_file:
+        return blob_file.read()
+
+
+def is_store_dir(path, store_dir=STORE_DIR):
+    path = os.path.normpath(path)
+    return path == store_dir or path.startswith(store_dir + os.sep)
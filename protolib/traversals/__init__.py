@@ -1,9 +1,12 @@
 import os
 import sys
+from pathlib import Path
 
 PROTOCOL_DIR = 'protocols'
 RELEASES_DIR = 'releases'
 PROTOCOLS_BUILD_DIR = 'protoBuilds'
+# content-addressed data shared by all builds (see protolib/store.py)
+STORE_DIR = os.path.join(PROTOCOLS_BUILD_DIR, '_store')
 ARGS = sys.argv[2::]
 
 
@@ -48,4 +51,21 @@ def search_directory(protocol_dir, file_type):
             continue
 
 
+def find_ot2_protocols(protocol_dir=PROTOCOL_DIR):
+    # Yields every OT2 APIv2 protocol file, skipping protocol dirs that
+    # contain a '.ignore' file (the same rule the Makefile applies).
+    for proto_dir in sorted(Path(protocol_dir).iterdir()):
+        if not proto_dir.is_dir() or (proto_dir / '.ignore').exists():
+            continue
+        yield from sorted(proto_dir.rglob('*.ot2.apiv2.py'))
+
+
+def ot2_build_path(
+    protocol_path, protocol_dir=PROTOCOL_DIR, build_dir=PROTOCOLS_BUILD_DIR
+):
+    # protocols/<slug>/<name>.ot2.apiv2.py -> <build_dir>/<slug>/<name>.json
+    relative = Path(protocol_path).relative_to(protocol_dir)
+    return Path(build_dir) / relative.parent / '{}.json'.format(relative.name)
+
+
 prepare_dirs(PROTOCOLS_BUILD_DIR, RELEASES_DIR, PROTOCOL_DIR)
@@ -1,8 +1,8 @@
 import os
 import json
 from pathlib import Path
-from parse import markdown as parser
-from traversals import PROTOCOLS_BUILD_DIR, PROTOCOL_DIR
+from protolib.parse import markdown as parser
+from protolib.traversals import PROTOCOLS_BUILD_DIR, PROTOCOL_DIR
 
 
 def write_README_to_json(protocol_path):
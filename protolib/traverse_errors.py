@@ -1,9 +1,9 @@
-import glob
 # import logging
 import os
 import json
+from fnmatch import fnmatch
 from pathlib import Path
-from traversals import PROTOCOLS_BUILD_DIR, PROTOCOL_DIR
+from protolib.traversals import PROTOCOLS_BUILD_DIR, PROTOCOL_DIR
 # file handler keys
 OT_1_PROTOCOL = 'OT 1 protocol'
 OT_2_PROTOCOL = 'OT 2 protocol'
@@ -26,7 +26,8 @@ def generate_metadata(root, _path, file_names):
     root: the single protocol dir we're parsing now
     _path: the path to the root protocols dir (probably is 'protocols')
     file_names: array of strings representing all file names
-    in the single protocol dir
+    in the single protocol dir (matched against `file_handlers` like
+    glob would, without listing the dir again)
     """
     path = Path(_path)
 
@@ -43,8 +44,8 @@ def generate_metadata(root, _path, file_names):
         },
         'files': {
             file_type: [
-                Path(f).name
-                for f in glob.glob(os.path.join(path, root, file_glob))]
+                f for f in file_names
+                if not f.startswith('.') and fnmatch(f, file_glob)]
             for file_type, file_glob in file_handlers.items()
         }
     }
@@ -0,0 +1,89 @@
+"""
+Builds metadata.json and README.json for every protocol in a single pass.
+
+Each protocol dir is listed once, and both build files are made from that
+listing. A README.md is only parsed again when its content or the README
+parser changed since its README.json was written (see `.key` files in
+protolib/parse/cache.py), and the parsing is spread across a process pool.
+Build files whose content is unchanged are not rewritten.
+
+    python -m protolib.traverse_protocols
+"""
+import json
+import multiprocessing
+import os
+
+from protolib.parse import cache
+from protolib.parse import markdown as parser
+from protolib.traverse_errors import generate_metadata, get_status
+from protolib.traversals import PROTOCOLS_BUILD_DIR, PROTOCOL_DIR
+
+
+def to_json(data):
+    return json.dumps(data, indent=4, sort_keys=True)
+
+
+def write_if_changed(path, text):
+    try:
+        with open(path, 'r') as f:
+            if f.read() == text:
+                return
+    except FileNotFoundError:
+        pass
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def parse_README(job):
+    readme_path, output_path, key = job
+    return output_path, key, to_json({**parser.parse(readme_path)})
+
+
+def scan_protocols(protocol_path):
+    """
+    Writes metadata.json for every protocol dir and returns the
+    (README path, README.json path, key) of READMEs that need parsing.
+    """
+    readme_jobs = []
+    with os.scandir(protocol_path) as proto_dirs:
+        for proto_dir in proto_dirs:
+            if not proto_dir.is_dir():
+                # maybe it's a .DS_Store or something
+                print(f'DEBUG: Not a directory: "{proto_dir.path}"')
+                continue
+            root = proto_dir.name
+            with os.scandir(proto_dir.path) as files:
+                file_names = [f.name for f in files]
+            build_path = os.path.join(PROTOCOLS_BUILD_DIR, root)
+            os.makedirs(build_path, exist_ok=True)
+
+            metadata = generate_metadata(root, protocol_path, file_names)
+            write_if_changed(
+                os.path.join(build_path, 'metadata.json'),
+                to_json({**metadata, 'status': get_status(metadata)}))
+
+            if 'README.md' not in file_names:
+                raise RuntimeError(
+                    f'Expected exactly 1 README.md, got 0 in {proto_dir.path}')
+            readme_path = os.path.join(proto_dir.path, 'README.md')
+            output_path = os.path.join(build_path, 'README.json')
+            key = cache.files_key([readme_path, parser.__file__])
+            if not cache.is_fresh(output_path, key):
+                readme_jobs.append((readme_path, output_path, key))
+    return readme_jobs
+
+
+def traverse_protocols(protocol_path, processes=None):
+    readme_jobs = scan_protocols(protocol_path)
+    print('README: {} READMEs need parsing'.format(len(readme_jobs)))
+    if not readme_jobs:
+        return
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.imap_unordered(parse_README, readme_jobs, chunksize=8)
+        for output_path, key, text in results:
+            write_if_changed(output_path, text)
+            cache.write_key(output_path, key)
+
+
+if __name__ == '__main__':
+    traverse_protocols(PROTOCOL_DIR)